@@ -3,9 +3,11 @@
 import argparse
 import configparser
 import contextlib
+import contextvars
 import datetime
-import filecmp
-import gzip
+import functools
+import hashlib
+import io
 import json
 import logging
 import os
@@ -13,20 +15,12 @@ import platform
 import random
 import re
 import shutil
+import socket
 import string
 import subprocess
-import tempfile
+import sys
+import threading
 import time
-import urllib.error
-import urllib.request
-import zipfile
-
-WITH_DBUS = True
-
-try:
-    import dbus
-except ImportError:
-    WITH_DBUS = False
 
 logging.basicConfig(
     format="[%(asctime)s] - %(levelname)s - %(message)s",
@@ -37,40 +31,99 @@ VERSION = '1.2.12'
 
 MAGISK_HOST = "https://huskydg.github.io/magisk-files/"
 MAGISK_CANARY = "%s/app-release.apk" % MAGISK_HOST
+MAGISK_CHANNEL_URL = "https://raw.githubusercontent.com/HuskyDG/magisk-files/main/"
+MAGISK_CHANNELS = ["canary", "debug"]
 
 WAYDROID_DIR = "/var/lib/waydroid/"
-CONFIG_FILE = os.path.join(WAYDROID_DIR, "waydroid.cfg")
 
-OVERLAY = os.path.join(WAYDROID_DIR, "overlay")
-INIT_OVERLAY = os.path.join(OVERLAY, "system", "etc", "init")
-MAGISK_OVERLAY = os.path.join(INIT_OVERLAY, "magisk")
+DATA_DIR = "/var/lib/waydroid_magisk"
+BUNDLE_DIR = os.path.join(DATA_DIR, "bundles")
+DOWNLOAD_CACHE = os.path.join(DATA_DIR, "cache")
+DOWNLOAD_CACHE_TTL = 3600
 
-OVERLAY_RW = os.path.join(WAYDROID_DIR, "overlay_rw")
-INIT_OVERLAY_RW = os.path.join(OVERLAY, "system", "etc", "init", "magisk")
-MAGISK_OVERLAY_RW = os.path.join(INIT_OVERLAY, "magisk")
+DAEMON_SOCKET = "/run/waydroid_magisk.sock"
+PACKAGE_CACHE_TTL = 30
+CHANNEL_CACHE_TTL = 3600
+UPDATE_AVAILABLE = 100
+FLEET_JOBS = 4
 
+# Relative to the Waydroid root of an instance
 MAGISK_FILES = [
-    "/var/lib/waydroid/overlay_rw/system/system/addon.d/99-magisk.sh",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/bootanim.rc",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/bootanim.rc.gz",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/boot_patch.sh",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/stub.apk",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/util_functions.sh",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/addon.d.sh",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/magisk64",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/magiskinit",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/magisk.apk",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/busybox",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/chromeos",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/config",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/magiskpolicy",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/magisk32",
-    "/var/lib/waydroid/overlay_rw/system/system/etc/init/magisk/magiskboot"]
+    "overlay_rw/system/system/addon.d/99-magisk.sh",
+    "overlay_rw/system/system/etc/init/bootanim.rc",
+    "overlay_rw/system/system/etc/init/bootanim.rc.gz",
+    "overlay_rw/system/system/etc/init/magisk/boot_patch.sh",
+    "overlay_rw/system/system/etc/init/magisk/stub.apk",
+    "overlay_rw/system/system/etc/init/magisk/util_functions.sh",
+    "overlay_rw/system/system/etc/init/magisk/addon.d.sh",
+    "overlay_rw/system/system/etc/init/magisk/magisk64",
+    "overlay_rw/system/system/etc/init/magisk/magiskinit",
+    "overlay_rw/system/system/etc/init/magisk/magisk.apk",
+    "overlay_rw/system/system/etc/init/magisk/busybox",
+    "overlay_rw/system/system/etc/init/magisk/chromeos",
+    "overlay_rw/system/system/etc/init/magisk/config",
+    "overlay_rw/system/system/etc/init/magisk/magiskpolicy",
+    "overlay_rw/system/system/etc/init/magisk/magisk32",
+    "overlay_rw/system/system/etc/init/magisk/magiskboot"]
 
 
 # UTILS
 
+# Heavy modules (asyncio, dbus, urllib, zipfile, gzip, tempfile, filecmp) are
+# imported by the functions that use them so quick queries and --help stay
+# cheap.
+# `make check_startup` fails if any of them is imported at module load.
+
+@functools.lru_cache(maxsize=None)
+def import_dbus():
+    try:
+        import dbus
+    except ImportError:
+        return None
+    return dbus
+
+
+class WaydroidInstance:
+    def __init__(self, waydroid_dir=WAYDROID_DIR) -> None:
+        self.waydroid_dir = os.path.join(os.path.abspath(waydroid_dir), "")
+        self.config_file = os.path.join(self.waydroid_dir, "waydroid.cfg")
+        self.lxc = os.path.join(self.waydroid_dir, "lxc")
+        self.overlay = os.path.join(self.waydroid_dir, "overlay")
+        self.init_overlay = os.path.join(self.overlay, "system", "etc", "init")
+        self.magisk_overlay = os.path.join(self.init_overlay, "magisk")
+        self.overlay_rw = os.path.join(self.waydroid_dir, "overlay_rw")
+        self.magisk_overlay_rw = os.path.join(
+            self.overlay_rw, "system", "system", "etc", "init", "magisk")
+        self.install_record = os.path.join(
+            self.waydroid_dir, "waydroid_magisk.json")
+        self.lock_file = os.path.join(self.waydroid_dir, "waydroid_magisk.lock")
+        self.generations_dir = os.path.join(
+            self.waydroid_dir, "waydroid_magisk_generations")
+        self.magisk_files = [os.path.join(self.waydroid_dir, mfile)
+                             for mfile in MAGISK_FILES]
+        # The Waydroid container manager on DBus only manages the default
+        # instance, the others are driven through their session.cfg and lxc.
+        self.is_default = self.waydroid_dir == os.path.join(
+            os.path.abspath(WAYDROID_DIR), "")
+
+
+_instance = contextvars.ContextVar("waydroid_instance", default=None)
+
+
+def instance():
+    inst = _instance.get()
+    if inst is None:
+        inst = WaydroidInstance()
+        _instance.set(inst)
+    return inst
+
+
+def set_instance(waydroid_dir=WAYDROID_DIR):
+    _instance.set(WaydroidInstance(waydroid_dir))
+
+
 def WaydroidContainerDbus():
+    dbus = import_dbus()
     return dbus.Interface(
         dbus.SystemBus().get_object(
             "id.waydro.Container", "/ContainerManager"),
@@ -78,29 +131,113 @@ def WaydroidContainerDbus():
 
 
 class WaydroidFreezeUnfreeze:
-    def __init__(self, session) -> None:
-        self._session = session
+    # Re-entrant: only the outermost scope reads the live session state and
+    # thaws the container, nested scopes just bump the depth. Wrap batches of
+    # container queries in one scope to run them within a single thaw.
+    _lock = threading.RLock()
+    _depth = {}
+    _thawed = {}
+
+    def __enter__(self):
+        cls = WaydroidFreezeUnfreeze
+        self._key = instance().waydroid_dir
+        with cls._lock:
+            if not cls._depth.get(self._key):
+                session = get_waydroid_session()
+                thawed = bool(session) and session.get("state") == "FROZEN"
+                cls._thawed[self._key] = thawed
+                if thawed:
+                    WaydroidContainerDbus().Unfreeze()
+            cls._depth[self._key] = cls._depth.get(self._key, 0) + 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        cls = WaydroidFreezeUnfreeze
+        with cls._lock:
+            cls._depth[self._key] -= 1
+            if not cls._depth[self._key] and cls._thawed.pop(self._key, False):
+                WaydroidContainerDbus().Freeze()
+
+
+class InstanceLock:
+    # flock on the lock file of the instance, across processes and threads:
+    # commands that rewrite the Magisk files hold it exclusively, queries and
+    # the OTA sync shared. Nested scopes of a thread reuse its lock, an
+    # exclusive scope inside a shared one upgrades it until it exits.
+    # Non-blocking scopes raise BlockingIOError when the lock is taken.
+    _local = threading.local()
+
+    def __init__(self, exclusive=False, blocking=True):
+        self.exclusive = exclusive
+        self.blocking = blocking
 
     def __enter__(self):
-        if self._frozen:
-            WaydroidContainerDbus().Unfreeze()
+        import fcntl
+        held = self._local.__dict__.setdefault("held", {})
+        self._path = instance().lock_file
+        state = held.get(self._path)
+        if state is None:
+            try:
+                fd = os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+            except (FileNotFoundError, PermissionError):
+                # No instance there or no rights to change it anyway.
+                fd = None
+            state = held[self._path] = {"fd": fd, "scopes": []}
+        if state["fd"] is not None and (
+                not state["scopes"] or (self.exclusive and not any(state["scopes"]))):
+            operation = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+            try:
+                fcntl.flock(state["fd"], operation | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not self.blocking:
+                    self._release(state)
+                    raise
+                logging.info("Waiting for another waydroid_magisk command on %s" %
+                             instance().waydroid_dir)
+                fcntl.flock(state["fd"], operation)
+        state["scopes"].append(self.exclusive)
+        return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        if self._frozen:
-            WaydroidContainerDbus().Freeze()
+        import fcntl
+        state = self._local.held[self._path]
+        state["scopes"].pop()
+        if not state["scopes"]:
+            self._release(state)
+        elif self.exclusive and not any(state["scopes"]) and state["fd"] is not None:
+            fcntl.flock(state["fd"], fcntl.LOCK_SH)
+
+    def _release(self, state):
+        if not state["scopes"]:
+            if state["fd"] is not None:
+                os.close(state["fd"])
+            del self._local.held[self._path]
+
+
+def exclusive(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with InstanceLock(exclusive=True):
+            return func(*args, **kwargs)
+    return wrapper
 
-    @property
-    def _frozen(self):
-        return self._session["state"] == "FROZEN" if self._session else False
+
+def shared(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with InstanceLock():
+            return func(*args, **kwargs)
+    return wrapper
 
 
 def mount_system():
+    inst = instance()
     if has_overlay():
         return True
     if is_running():
         return False
-    if not os.path.exists(OVERLAY):
-        os.mkdir(OVERLAY)
+    if not os.path.exists(inst.overlay):
+        os.mkdir(inst.overlay)
     rootfs = get_systemimg_path()
     subprocess.run(["e2fsck", "-y", "-f", rootfs],
                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
@@ -109,9 +246,9 @@ def mount_system():
     tries = 5
     for x in range(tries):
         with contextlib.suppress(subprocess.CalledProcessError):
-            subprocess.run(["mount", "-o", "rw,loop", rootfs, OVERLAY],
+            subprocess.run(["mount", "-o", "rw,loop", rootfs, inst.overlay],
                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if os.path.ismount(OVERLAY):
+        if os.path.ismount(inst.overlay):
             return True
         time.sleep(1)
     logging.info("Failed to mount waydroid system")
@@ -119,13 +256,14 @@ def mount_system():
 
 
 def umount_system():
+    inst = instance()
     tries = 5
     for x in range(tries):
         with contextlib.suppress(subprocess.CalledProcessError):
             subprocess.run(
-                ["umount", OVERLAY],
+                ["umount", inst.overlay],
                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if not os.path.ismount(OVERLAY):
+        if not os.path.ismount(inst.overlay):
             return True
     time.sleep(1)
     logging.info("Failed to umount waydroid system")
@@ -133,22 +271,123 @@ def umount_system():
 
 
 class SystemMount:
+    # Re-entrant per instance so a transaction can keep the system mounted
+    # across the nested install/uninstall calls.
+    _lock = threading.Lock()
+    _depth = {}
+    _mounted = {}
+
     def __enter__(self):
-        return mount_system()
+        cls = SystemMount
+        self._key = instance().waydroid_dir
+        with cls._lock:
+            if not cls._depth.get(self._key):
+                cls._mounted[self._key] = mount_system()
+            cls._depth[self._key] = cls._depth.get(self._key, 0) + 1
+            return cls._mounted[self._key]
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        umount_system()
+        cls = SystemMount
+        with cls._lock:
+            cls._depth[self._key] -= 1
+            if not cls._depth[self._key]:
+                umount_system()
+
 
+_download_locks = {}
+_download_locks_lock = threading.Lock()
 
-def download_obj(url, destination, filename):
+
+def fetch_to_cache(url, cached, filename, headers=None, sha256=None):
+    # Returns the response headers, or None when the server answered that
+    # the cached copy is still current.
+    import urllib.error
+    import urllib.request
+    tmp = "%s.%s.%s.tmp" % (cached, os.getpid(), threading.get_ident())
     try:
-        with urllib.request.urlopen(url) as response:
-            with open(os.path.join(destination, filename), "wb") as handle:
-                shutil.copyfileobj(response, handle)
+        request = urllib.request.Request(url, headers=headers or {})
+        with urllib.request.urlopen(request) as response, open(tmp, "wb") as handle:
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: response.read(1024 * 1024), b""):
+                digest.update(chunk)
+                handle.write(chunk)
+            info = dict(response.headers)
+        if sha256 and digest.hexdigest() != sha256:
+            raise ValueError("Downloaded %s doesn't match its sha256 from the channel" % filename)
+        os.replace(tmp, cached)
+        return info
     except urllib.error.HTTPError as exc:
+        if exc.code == 304:
+            return None
         raise ValueError("Failed to download %s: %s" % (filename, exc.code))
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+
+
+def cache_obj(url, filename, sha256=None):
+    # Downloads go through a cache shared by every instance, so a fleet wide
+    # install fetches each url once. Links keep their name across releases:
+    # with the sha256 of the channel the cache is keyed by content, otherwise
+    # the copy of the url is revalidated with its ETag/Last-Modified, or
+    # downloaded again after DOWNLOAD_CACHE_TTL when the server sends none.
+    import urllib.error
+    if sha256:
+        cached = os.path.join(DOWNLOAD_CACHE, "sha256-%s" % sha256)
+    else:
+        cached = os.path.join(
+            DOWNLOAD_CACHE, hashlib.sha256(url.encode()).hexdigest())
+    meta_path = cached + ".meta"
+    with _download_locks_lock:
+        lock = _download_locks.setdefault(cached, threading.Lock())
+    with lock:
+        os.makedirs(DOWNLOAD_CACHE, exist_ok=True)
+        if sha256:
+            if os.path.isfile(cached) and sha256sum(cached) != sha256:
+                logging.warning("Cached %s is corrupt, downloading it again" % filename)
+                os.remove(cached)
+            if not os.path.isfile(cached):
+                fetch_to_cache(url, cached, filename, sha256=sha256)
+        else:
+            try:
+                with open(meta_path, "r") as handle:
+                    meta = json.load(handle)
+            except (OSError, ValueError):
+                meta = {}
+            fresh = os.path.isfile(cached) and meta.get("url") == url
+            validators = {key: meta[key] for key in ["ETag", "Last-Modified"] if meta.get(key)}
+            if not fresh or validators or time.time() - meta.get("fetched", 0) >= DOWNLOAD_CACHE_TTL:
+                headers = {}
+                if fresh and "ETag" in validators:
+                    headers["If-None-Match"] = validators["ETag"]
+                if fresh and "Last-Modified" in validators:
+                    headers["If-Modified-Since"] = validators["Last-Modified"]
+                try:
+                    info = fetch_to_cache(url, cached, filename, headers)
+                except urllib.error.URLError as exc:
+                    if not fresh:
+                        raise ValueError("Failed to download %s: %s" % (filename, exc.reason))
+                    logging.warning("Failed to check %s, using the cached copy" % filename)
+                    info = None
+                if info is not None:
+                    meta = {"url": url, "fetched": time.time()}
+                    meta.update({key: info[key] for key in ["ETag", "Last-Modified"]
+                                 if info.get(key)})
+                    tmp = "%s.%s.tmp" % (meta_path, os.getpid())
+                    with open(tmp, "w") as handle:
+                        json.dump(meta, handle)
+                    os.replace(tmp, meta_path)
+    return cached
+
+
+def download_obj(url, destination, filename, sha256=None):
+    shutil.copyfile(cache_obj(url, filename, sha256),
+                    os.path.join(destination, filename))
 
 
 def download_json(url, scope):
+    import urllib.error
+    import urllib.request
     result = {}
     try:
         with urllib.request.urlopen(url) as response:
@@ -159,10 +398,67 @@ def download_json(url, scope):
     return result
 
 
+def channel_json_url(channel, channel_url=None):
+    # channel_url is the directory holding <channel>.json, upstream or a
+    # mirror made by `mirror sync` (http(s)://, file:// or a local path).
+    base = channel_url or os.environ.get("WAYDROID_MAGISK_CHANNEL_URL") or MAGISK_CHANNEL_URL
+    if "://" not in base:
+        base = "file://" + os.path.abspath(base)
+    return "%s/%s.json" % (base.rstrip("/"), channel)
+
+
+def resolve_links(metadata, json_url):
+    # Mirrors store links relative to the channel file.
+    import urllib.parse
+    for section in metadata.values():
+        if isinstance(section, dict):
+            for key in ["link", "note"]:
+                if section.get(key):
+                    section[key] = urllib.parse.urljoin(json_url, section[key])
+    return metadata
+
+
+def cached_json(url, scope, ttl):
+    # Falls back to a stale copy when the download fails, so a check while
+    # offline still answers.
+    cached = os.path.join(
+        DOWNLOAD_CACHE, "%s.json" % hashlib.sha256(url.encode()).hexdigest())
+    try:
+        age = time.time() - os.stat(cached).st_mtime
+    except FileNotFoundError:
+        age = None
+    if age is not None and age < ttl:
+        with contextlib.suppress(OSError, ValueError):
+            with open(cached, "r") as handle:
+                return json.load(handle)
+    try:
+        result = download_json(url, scope)
+    except (OSError, ValueError) as exc:
+        if age is None:
+            raise ValueError("Failed to download %s: %s" % (scope, exc))
+        logging.warning("Failed to download %s, using the copy from %d minutes ago" %
+                        (scope, age // 60))
+        with open(cached, "r") as handle:
+            return json.load(handle)
+    with contextlib.suppress(OSError):
+        if not os.path.isdir(DOWNLOAD_CACHE):
+            os.makedirs(DOWNLOAD_CACHE)
+        tmp = "%s.%s.tmp" % (cached, os.getpid())
+        with open(tmp, "w") as handle:
+            json.dump(result, handle)
+        os.replace(tmp, cached)
+    return result
+
+
+async def cached_json_async(url, scope, ttl):
+    import asyncio
+    return await asyncio.to_thread(cached_json, url, scope, ttl)
+
+
 def is_running():
     waydroid_session = get_waydroid_session()
     if not waydroid_session:
-        return os.path.exists(os.path.join(WAYDROID_DIR, "session.cfg"))
+        return os.path.exists(os.path.join(instance().waydroid_dir, "session.cfg"))
     return waydroid_session.get("state") is not None
 
 def is_root():
@@ -170,17 +466,18 @@ def is_root():
 
 
 def is_waydroid_initialized():
-    return os.path.exists(CONFIG_FILE)
+    return os.path.exists(instance().config_file)
 
 
 def has_overlay():
     config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    config.read(instance().config_file)
     if "mount_overlays" in config["waydroid"].keys():
         return config["waydroid"]["mount_overlays"].lower() == "true"
     return False
 
 
+@functools.lru_cache(maxsize=None)
 def get_arch():
     plat = platform.machine()
     if plat == "x86":
@@ -200,7 +497,8 @@ def get_arch():
 
 
 def get_waydroid_session():
-    if WITH_DBUS:
+    dbus = import_dbus()
+    if dbus and instance().is_default:
         try:
             return WaydroidContainerDbus().GetSession()
         except dbus.exceptions.DBusException:
@@ -209,7 +507,7 @@ def get_waydroid_session():
 
 def get_systemimg_path():
     config = configparser.ConfigParser()
-    config.read(CONFIG_FILE)
+    config.read(instance().config_file)
     return os.path.join(config["waydroid"]["images_path"], "system.img")
 
 
@@ -218,10 +516,14 @@ def xdg_data_home():
     if waydroid_session:
         return waydroid_session["xdg_data_home"]
     cfg = configparser.ConfigParser()
-    cfg.read(os.path.join(WAYDROID_DIR, "session.cfg"))
+    cfg.read(os.path.join(instance().waydroid_dir, "session.cfg"))
     return cfg["session"]["xdg_data_home"]
 
 
+def container_data(*path):
+    return os.path.join(xdg_data_home(), "waydroid", "data", *path)
+
+
 def stop_session_if_needed():
     waydroid_session = get_waydroid_session()
     if waydroid_session:
@@ -254,7 +556,7 @@ def _restart_session_if_needed():
                 "Stopping Waydroid in %s (press ^C to cancel)" %
                 (seconds - i))
             time.sleep(1)
-        lxc = os.path.join(WAYDROID_DIR, "lxc")
+        lxc = instance().lxc
         command = ["lxc-attach", "-P", lxc, "-n",
                    "waydroid", "--", "service", "call", "waydroidhardware", "4"]
         logging.info("Stopping waydroid")
@@ -265,160 +567,274 @@ def _restart_session_if_needed():
 
 # Manager
 
-def su(args=None, pipe=True):
+# Independent container queries are gathered on an asyncio loop, bounded so
+# a burst of queries doesn't spawn an unbounded number of lxc-attach calls.
+CONTAINER_CONCURRENCY = 4
+
+# The semaphore of the loop running in each thread, fleet workers run
+# their own loops in parallel.
+_container_semaphore = threading.local()
+
+# Persistent su shells of the daemon and of API managers, per Waydroid root.
+_container_shells = {}
+
+
+def container_env():
+    return {"PATH": os.environ['PATH'] + ":/system/bin:/vendor/bin"}
+
+
+def container_shell():
+    return _container_shells.get(instance().waydroid_dir)
+
+
+def gather(*coros):
+    import asyncio
+
+    async def _gather():
+        return await asyncio.gather(*coros)
+    return asyncio.run(_gather())
+
+
+async def run_async(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    if getattr(_container_semaphore, "loop", None) is not loop:
+        _container_semaphore.loop = loop
+        _container_semaphore.semaphore = asyncio.Semaphore(CONTAINER_CONCURRENCY)
+    async with _container_semaphore.semaphore:
+        proc = await asyncio.create_subprocess_exec(
+            *command, env=container_env(), stdout=stdout, stderr=stderr)
+        out, err = await proc.communicate()
+    return proc.returncode, out or b"", err or b""
+
+
+async def su_async(args):
+    shell = container_shell()
+    if shell:
+        import asyncio
+        try:
+            return await asyncio.to_thread(shell.run, " ".join(args))
+        except OSError as exc:
+            logging.debug("Container shell unavailable: %s" % exc)
+    lxc = instance().lxc
+    command = ["lxc-attach", "-P", lxc, "-n", "waydroid", "--", "su", "-c"]
+    command.extend(args)
+    _status, out, _err = await run_async(command, stderr=subprocess.DEVNULL)
+    return out.decode()
+
+
+async def magisk_cmd_async(args, pipe=True):
+    lxc = instance().lxc
+    command = ["lxc-attach", "-P", lxc, "-n",
+               "waydroid", "--", "/sbin/magisk"]
+    command.extend(args)
+    if not pipe:
+        status, _out, _err = await run_async(command, stdout=None, stderr=None)
+        return (status, "")
+    _status, out, err = await run_async(command)
+    if out:
+        return (0, out.decode())
+    elif err:
+        return (1, err.decode())
+    return (0, "")
+
+
+async def magisk_sqlite_async(query):
+    lxc = instance().lxc
+    command = ["lxc-attach", "-P", lxc, "-n", "waydroid",
+               "--", "/sbin/magisk", "--sqlite", query]
+    _status, out, _err = await run_async(command, stderr=subprocess.DEVNULL)
+    return out.decode()
+
+
+def magisk_ready():
     if not is_root():
         logging.error("This command needs to be ran as a priviliged user!")
-        return
+        return False
     if not is_running():
         logging.error("Waydroid session is not running")
-        return
+        return False
     if not is_installed():
         logging.error("Kitsune Mask is not installed")
+        return False
+    return True
+
+
+def make_tty():
+    lxc = instance().lxc
+    command = [
+        "lxc-attach", "-P", lxc, "-n", "waydroid", "--", "su", "-c",
+        "mknod", "-m", "666", "/dev/tty", "c", "5", "0", "2>", "/dev/null"]
+    subprocess.run(command, env=container_env())
+
+
+def su_many(*commands):
+    if not magisk_ready():
         return
-    result = ""
-    waydroid_session = get_waydroid_session()
-    with WaydroidFreezeUnfreeze(waydroid_session):
-        lxc = os.path.join(WAYDROID_DIR, "lxc")
-        command = [
-            "lxc-attach", "-P", lxc, "-n", "waydroid", "--", "su", "-c",
-            "mknod", "-m", "666", "/dev/tty", "c", "5", "0", "2>", "/dev/null"]
-        subprocess.run(
-            command,
-            env={"PATH": os.environ['PATH'] + ":/system/bin:/vendor/bin"})
+    with WaydroidFreezeUnfreeze():
+        if not container_shell():
+            make_tty()
+        return gather(*(su_async(args) for args in commands))
+
+
+def su(args=None, pipe=True):
+    if args and pipe:
+        results = su_many(args)
+        return results[0] if results else results
+    if not magisk_ready():
+        return
+    with WaydroidFreezeUnfreeze():
+        make_tty()
+        lxc = instance().lxc
         command = ["lxc-attach", "-P", lxc, "-n", "waydroid", "--", "su"]
         if args:
             command.append("-c")
             command.extend(args)
-        if not args:
-            subprocess.run(
-                command,
-                env={"PATH": os.environ['PATH'] + ":/system/bin:/vendor/bin"}, 
-                stdout=subprocess.PIPE if pipe else None, 
-                stderr=subprocess.DEVNULL)
-        else:
-            proc = subprocess.run(
-                command,
-                env={"PATH": os.environ['PATH'] + ":/system/bin:/vendor/bin"},
-                stdout=subprocess.PIPE if pipe else None,
-                stderr=subprocess.DEVNULL)
-            if proc.stdout:
-                result = proc.stdout.decode()
-    return result
+        subprocess.run(
+            command, env=container_env(),
+            stdout=subprocess.PIPE if pipe else None,
+            stderr=subprocess.DEVNULL)
+    return ""
 
 
 def magisk_cmd(args, pipe=True):
-    pipe = subprocess.PIPE if pipe else None
-
-    status = 0
-    result = ""
-    if not is_root():
-        logging.error("This command needs to be ran as a priviliged user!")
-        return
-    if not is_running():
-        logging.error("Waydroid session is not running")
+    if not magisk_ready():
         return
-    if not is_installed():
-        logging.error("Kitsune Mask is not installed")
+    with WaydroidFreezeUnfreeze():
+        return gather(magisk_cmd_async(args, pipe=pipe))[0]
+
+
+def magisk_sqlite_many(*queries):
+    if not magisk_ready():
         return
-    waydroid_session = get_waydroid_session()
-    with WaydroidFreezeUnfreeze(waydroid_session):
-        lxc = os.path.join(WAYDROID_DIR, "lxc")
-        command = ["lxc-attach", "-P", lxc, "-n",
-                   "waydroid", "--", "/sbin/magisk"]
-        command.extend(args)
-        proc = subprocess.run(
-            command,
-            env={"PATH": os.environ['PATH'] + ":/system/bin:/vendor/bin"},
-            stderr=pipe, stdout=pipe)
-        if proc.stdout:
-            status = 0
-            result = proc.stdout.decode()
-        elif proc.stderr:
-            status = 1
-            result = proc.stderr.decode()
-    return (status, result)
+    with WaydroidFreezeUnfreeze():
+        return gather(*(magisk_sqlite_async(query) for query in queries))
 
 
 def magisk_sqlite(query):
-    if not is_root():
-        logging.error("This command needs to be ran as a priviliged user!")
-        return
-    if not is_running():
-        logging.error("Waydroid session is not running")
-        return
-    if not is_installed():
-        logging.error("Kitsune Mask is not installed")
-        return
-    result = ""
-    waydroid_session = get_waydroid_session()
-    with WaydroidFreezeUnfreeze(waydroid_session):
-        lxc = os.path.join(WAYDROID_DIR, "lxc")
-        command = ["lxc-attach", "-P", lxc, "-n", "waydroid",
-                   "--", "/sbin/magisk", "--sqlite", query]
-        proc = subprocess.run(
-            command,
-            env={"PATH": os.environ['PATH'] + ":/system/bin:/vendor/bin"},
-            universal_newlines=False, stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL)
-        result = proc.stdout.decode()
-    return result
+    results = magisk_sqlite_many(query)
+    return results[0] if results else results
 
 
-def list_modules():
-    if not is_root():
-        logging.error("This command needs to be ran as a priviliged user!")
-        return
-    if not is_running():
-        logging.error("Waydroid session is not running")
-        return
-    if not is_installed():
-        logging.error("Kitsune Mask is not installed")
-        return
-    waydroid_session = get_waydroid_session()
-    with WaydroidFreezeUnfreeze(waydroid_session):
-        modpath = os.path.join(
-            xdg_data_home(), "waydroid", "data", "adb", "modules")
-        if not os.path.isdir(modpath):
-            logging.error("No Magisk modules are currently installed")
-            return
-        print("\n".join("- %s" % mod for mod in os.listdir(modpath)))
+_package_cache = {}
 
 
-def remove_module(modname):
-    if not is_root():
-        logging.error("This command needs to be ran as a priviliged user!")
-        return
-    if not is_running():
-        logging.error("Waydroid session is not running")
-        return
-    if not is_installed():
-        logging.error("Kitsune Mask is not installed")
-        return
-    waydroid_session = get_waydroid_session()
-    with WaydroidFreezeUnfreeze(waydroid_session):
-        modpath = os.path.join(
-            xdg_data_home(), "waydroid", "data", "adb", "modules")
-        if not os.path.isdir(os.path.join(modpath, modname)):
-            logging.error("'%s' is not an installed Magisk module" % modname)
-            return
-        logging.info("Removing '%s' Magisk module" % modname)
-        while os.path.isdir(os.path.join(modpath, modname)):
-            shutil.rmtree(os.path.join(modpath, modname))
-        logging.info("'%s' Magisk module has been removed" % modname)
-        restart_session_if_needed()
+def list_packages():
+    # Cached so that resolving every row of the policies table costs a
+    # single `pm list packages` call, and the daemon can reuse it.
+    cache = _package_cache.setdefault(
+        instance().waydroid_dir, {"time": 0, "packages": []})
+    if time.monotonic() - cache["time"] > PACKAGE_CACHE_TTL:
+        result = su(["pm", "list", "packages", "-U"])
+        if result is None:
+            return []
+        cache["packages"] = [
+            line for line in result.splitlines() if line.startswith("package:")]
+        cache["time"] = time.monotonic()
+    return cache["packages"]
 
 
 def get_package(query):
     name = ""
     app_id = 0
-    result = su(["pm", "list", "packages -U", "|", "grep", str(query)])
-    if result:
-        name, app_id = result.split()
-        name = name.split(":")[-1]
-        app_id = int(app_id.split(":")[-1])
+    for line in list_packages():
+        if str(query) in line:
+            name, app_id = line.split()
+            name = name.split(":")[-1]
+            app_id = int(app_id.split(":")[-1])
+            break
     return (name, app_id)
 
 
+def package_uids():
+    uids = {}
+    for line in list_packages():
+        name, uid = line.split()
+        uids[name.split(":")[-1]] = int(uid.split(":")[-1])
+    return uids
+
+
+HIDE_TARGET = re.compile(r"^[A-Za-z0-9_.:-]+$")
+
+
+def read_hidelist(lines):
+    # "PKG [PROC]" (or "PKG|PROC" as printed by magiskhide ls) per line,
+    # a PKG without PROC hides every process of the package.
+    entries = set()
+    for line in lines:
+        fields = line.split("#", 1)[0].replace("|", " ").split()
+        if not fields:
+            continue
+        if len(fields) > 2 or not all(HIDE_TARGET.match(field) for field in fields):
+            logging.error("Invalid hidelist entry: %s" % line.strip())
+            return None
+        entries.add((fields[0], fields[1] if len(fields) > 1 else None))
+    return entries
+
+
+def diff_hidelist(current, desired):
+    packages = {pkg for pkg, proc in desired if proc is None}
+    adds = []
+    for pkg, proc in sorted(desired, key=format_hide_entry):
+        if proc is None:
+            if not any(entry[0] == pkg for entry in current):
+                adds.append((pkg, None))
+        elif (pkg, proc) not in current:
+            adds.append((pkg, proc))
+    removes = []
+    stale = {entry for entry in current
+             if entry[0] not in packages and entry not in desired}
+    for pkg in sorted({entry[0] for entry in stale}):
+        if all(entry in stale for entry in current if entry[0] == pkg):
+            removes.append((pkg, None))
+        else:
+            removes.extend(sorted(entry for entry in stale if entry[0] == pkg))
+    return adds, removes
+
+
+def format_hide_entry(entry):
+    return "|".join(field for field in entry if field)
+
+
+def apply_hidelist(desired, current=None):
+    if not magisk_ready():
+        return
+    with WaydroidFreezeUnfreeze():
+        if current is None:
+            status, message = magisk_cmd(["magiskhide", "ls"])
+            if status == 1:
+                logging.error(message)
+                return
+            current = read_hidelist(message.splitlines())
+        if current is None:
+            return
+        adds, removes = diff_hidelist(current, desired)
+        if not adds and not removes:
+            logging.info("Hidelist is up to date")
+            return True
+        # All changes go through a single su session, the entries that
+        # failed are echoed back.
+        script = []
+        for action, entries in [("rm", removes), ("add", adds)]:
+            for entry in entries:
+                script.append(
+                    "/sbin/magisk magiskhide %s %s > /dev/null 2>&1 || echo '%s'" % (
+                        action, " ".join(field for field in entry if field),
+                        format_hide_entry(entry)))
+        result = su(["; ".join(script)])
+    if result is None:
+        return
+    failed = set(result.split())
+    for prefix, entries in [("-", removes), ("+", adds)]:
+        for entry in entries:
+            if format_hide_entry(entry) in failed:
+                logging.error("Failed to %s %s" % (
+                    "remove" if prefix == "-" else "add", format_hide_entry(entry)))
+            else:
+                print("%s %s" % (prefix, format_hide_entry(entry)))
+    return not failed
+
+
 def magisk_log(save=False):
     if not is_root():
         logging.error("This command needs to be ran as a priviliged user!")
@@ -458,42 +874,111 @@ def magisk_log(save=False):
             out.write("waydroid arch=%s\n" % get_arch()[0])
             out.write("waydroid version=%s" % proc.stdout.decode())
 
+            props, env, mountinfo, log_text = su_many(
+                ["getprop"], ["env"], ["cat", "/proc/self/mountinfo"],
+                ["cat", "/cache/magisk.log"])
+
             out.write("\n\n---System Properties---\n\n")
-            out.write(su(["getprop"]))
+            out.write(props)
 
             out.write("\n\n---Environment Variables---\n\n")
-            out.write(su(["env"]))
+            out.write(env)
 
             out.write("\n\n---System MountInfo---\n\n")
-            out.write(su(["cat", "/proc/self/mountinfo"]))
+            out.write(mountinfo)
 
             out.write("\n---Manager Logs---\n")
-            out.write(su("cat", "/cache/magisk.log"))
+            out.write(log_text)
             logging.info("Logs saved to: %s" % save_to)
 
 
-def magisk_status():
-    if not is_root():
-        logging.error("This command needs to be ran as a priviliged user!")
-        return
-    if not is_running():
-        logging.error("Waydroid session is not running")
-        return
-    if not is_installed():
-        logging.error("Kitsune Mask is not installed")
-        return
-    daemon_running = bool(su(["pidof", "magiskd"]))
-    logging.info("Daemon: %s" % ("Running" if daemon_running else "Stopped"))
-    if not daemon_running:
-        if os.path.isfile("/var/log/syslog"):
-            with open("/var/log/syslog", "r") as dmesg:
-                error = "Abort message: 'stack corruption detected (-fstack-protector)'"
-                if dmesg.read().find(error) > -1:
-                    logging.error(error)
-    logging.info("Magisk Version: %s" % su(["magisk", "su", "--version"]))
+MODULE_BINARY = "META-INF/com/google/android/update-binary"
+MODULE_ID = re.compile(r"^[a-zA-Z][a-zA-Z0-9._-]+$")
+
+
+def parse_module_prop(lines):
+    props = {}
+    for line in lines:
+        key, sep, value = line.strip().partition("=")
+        if sep and not key.startswith("#"):
+            props[key.strip()] = value.strip()
+    return props
+
+
+def read_module_prop(path):
+    with open(path, "r", errors="replace") as handle:
+        return parse_module_prop(handle)
+
+
+def check_module_zip(path):
+    import zipfile
+    import zlib
+    result = {"path": path, "id": None, "version": None, "versionCode": None,
+              "size": 0, "zip_size": 0, "errors": []}
+    errors = result["errors"]
+    try:
+        result["zip_size"] = os.path.getsize(path)
+        with zipfile.ZipFile(path) as archive:
+            infos = archive.infolist()
+            names = set(info.filename for info in infos)
+            result["size"] = sum(info.file_size for info in infos)
+            if "module.prop" in names:
+                props = parse_module_prop(
+                    archive.read("module.prop").decode(errors="replace").splitlines())
+                for key in ["id", "version", "versionCode"]:
+                    result[key] = props.get(key)
+                if not props.get("id"):
+                    errors.append("module.prop has no id")
+                elif not MODULE_ID.match(props["id"]):
+                    errors.append("module.prop has an invalid id '%s'" % props["id"])
+            else:
+                nested = sorted(name for name in names if name.endswith("/module.prop"))
+                if nested:
+                    errors.append("module.prop is in %s, zip the content of the module folder instead" %
+                                  os.path.dirname(nested[0]))
+                else:
+                    errors.append("module.prop is missing")
+            if MODULE_BINARY not in names:
+                errors.append("%s is missing" % MODULE_BINARY)
+            # Reading every member to the end makes zipfile check its CRC.
+            for info in infos:
+                try:
+                    with archive.open(info) as member:
+                        while member.read(1024 * 1024):
+                            pass
+                except (zipfile.BadZipFile, zlib.error, EOFError, NotImplementedError) as exc:
+                    errors.append("%s: %s" % (info.filename, exc))
+    except (OSError, zipfile.BadZipFile, zipfile.LargeZipFile) as exc:
+        errors.append(str(exc))
+    return result
 
 
-def install_module(modpath):
+def check_module_zips(paths):
+    import concurrent.futures
+    # zlib releases the GIL while inflating and checking CRCs, so a batch is
+    # validated on all cores with threads.
+    jobs = max(1, min(len(paths), os.cpu_count() or 1))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        return list(pool.map(check_module_zip, paths))
+
+
+def preflight_modules(paths):
+    results = check_module_zips(paths)
+    errors = ["%s: %s" % (result["path"], error)
+              for result in results for error in result["errors"]]
+    data_dir = is_running() and os.path.join(xdg_data_home(), "waydroid", "data")
+    if results and data_dir and os.path.isdir(data_dir):
+        # Each zip is copied into the data dir before Magisk extracts it.
+        needed = sum(result["size"] for result in results) + \
+            max(result["zip_size"] for result in results)
+        free = shutil.disk_usage(data_dir).free
+        if needed > free:
+            errors.append("The modules need %.1f MiB in %s, only %.1f MiB are free" %
+                          (needed / 2**20, data_dir, free / 2**20))
+    return results, errors
+
+
+def install_module(modpath, restart_after=True):
     if not is_root():
         logging.error("This command needs to be ran as a priviliged user!")
         return
@@ -503,7 +988,6 @@ def install_module(modpath):
     if not is_installed():
         logging.error("Kitsune Mask is not installed")
         return
-    waydroid_session = get_waydroid_session()
     tmpdir = os.path.join(xdg_data_home(), "waydroid",
                           "data", "adb", "magisk_tmp")
     if not os.path.exists(tmpdir):
@@ -511,76 +995,219 @@ def install_module(modpath):
     shutil.copyfile(modpath, os.path.join(tmpdir, "module.zip"))
     args = ["--install-module",
             os.path.join("/data", "adb", "magisk_tmp", "module.zip")]
-    magisk_cmd(args, pipe=False)
+    result = magisk_cmd(args, pipe=False)
     os.remove(os.path.join(tmpdir, "module.zip"))
-    restart_session_if_needed()
+    if not result or result[0] != 0:
+        logging.error("Failed to install %s" % modpath)
+        return
+    if restart_after:
+        restart_session_if_needed()
+    return True
 
 
-def list_modules():
-    if not is_root():
-        logging.error("This command needs to be ran as a priviliged user!")
-        return
-    if not is_running():
-        logging.error("Waydroid session is not running")
-        return
-    if not is_installed():
-        logging.error("Kitsune Mask is not installed")
-        return
-    waydroid_session = get_waydroid_session()
-    with WaydroidFreezeUnfreeze(waydroid_session):
-        modpath = os.path.join(
-            xdg_data_home(), "waydroid", "data", "adb", "modules")
-        if not os.path.isdir(modpath):
-            logging.error("No Magisk modules are currently installed")
-            return
-        print("\n".join("- %s" % mod for mod in os.listdir(modpath)))
+# Module store
 
+# Module zips are kept by sha256 and indexed by the id and versionCode of
+# their module.prop, shared by every instance.
+MODULE_STORE = os.path.join(DATA_DIR, "modules")
+MODULE_STORE_INDEX = os.path.join(MODULE_STORE, "index.json")
+# Runtime flags Magisk keeps next to a module, not part of the module.
+MODULE_FLAGS = ["disable", "remove", "update"]
+MODULE_INSTALLER = """#!/sbin/sh
 
-def remove_module(modname):
-    if not is_root():
-        logging.error("This command needs to be ran as a priviliged user!")
-        return
-    if not is_running():
-        logging.error("Waydroid session is not running")
-        return
-    if not is_installed():
-        logging.error("Kitsune Mask is not installed")
-        return
-    waydroid_session = get_waydroid_session()
-    with WaydroidFreezeUnfreeze(waydroid_session):
-        modpath = os.path.join(
-            xdg_data_home(), "waydroid", "data", "adb", "modules")
-        if not os.path.isdir(os.path.join(modpath, modname)):
-            logging.error("'%s' is not an installed Magisk module" % modname)
+#################
+# Initialization
+#################
+
+umask 022
+
+# echo before loading util_functions
+ui_print() { echo "$1"; }
+
+require_new_magisk() {
+  ui_print "*******************************"
+  ui_print " Please install Magisk v20.4+! "
+  ui_print "*******************************"
+  exit 1
+}
+
+#########################
+# Load util_functions.sh
+#########################
+
+OUTFD=$2
+ZIPFILE=$3
+
+mount /data 2>/dev/null
+
+[ -f /data/adb/magisk/util_functions.sh ] || require_new_magisk
+. /data/adb/magisk/util_functions.sh
+[ $MAGISK_VER_CODE -lt 20400 ] && require_new_magisk
+
+install_module
+exit 0
+"""
+
+
+@contextlib.contextmanager
+def module_store_lock():
+    # flock next to the index: the store is shared by every instance and
+    # by concurrent commands, not just the threads of this process.
+    import fcntl
+    os.makedirs(MODULE_STORE, exist_ok=True)
+    fd = os.open(os.path.join(MODULE_STORE, ".lock"),
+                 os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def read_module_store():
+    try:
+        with open(MODULE_STORE_INDEX, "r") as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return {"format": 1, "modules": {}}
+
+
+def version_code(entry):
+    try:
+        return int(entry.get("versionCode") or 0)
+    except ValueError:
+        return 0
+
+
+def stored_module(modid):
+    # <id> picks the highest versionCode, <id>@<versionCode> a given one.
+    modid, _, code = modid.partition("@")
+    entries = [(digest, entry) for digest, entry in read_module_store()["modules"].items()
+               if entry["id"] == modid and (not code or entry.get("versionCode") == code)]
+    if not entries:
+        return None
+    digest, entry = max(entries, key=lambda item: (version_code(item[1]), item[1]["added"]))
+    return os.path.join(MODULE_STORE, "%s.zip" % digest)
+
+
+def resolve_module(modpath):
+    if os.path.isfile(modpath):
+        return modpath
+    return stored_module(modpath)
+
+
+def store_module(path, props):
+    digest = sha256sum(path)
+    destination = os.path.join(MODULE_STORE, "%s.zip" % digest)
+    with module_store_lock():
+        index = read_module_store()
+        if digest in index["modules"] and os.path.isfile(destination):
+            return digest, False
+        if os.path.abspath(path) != destination:
+            tmp = "%s.%s.tmp" % (destination, os.getpid())
+            shutil.copyfile(path, tmp)
+            os.replace(tmp, destination)
+        index["modules"][digest] = {
+            "id": props.get("id"), "name": props.get("name"),
+            "version": props.get("version"), "versionCode": props.get("versionCode"),
+            "size": os.path.getsize(destination),
+            "added": datetime.datetime.now().isoformat(timespec="seconds")}
+        tmp = "%s.%s.tmp" % (MODULE_STORE_INDEX, os.getpid())
+        with open(tmp, "w") as handle:
+            json.dump(index, handle, indent=2, sort_keys=True)
+        os.replace(tmp, MODULE_STORE_INDEX)
+    return digest, True
+
+
+def pack_module(moddir, destination):
+    import stat
+    import zipfile
+    # Fixed timestamps and member order, so exporting the same module twice
+    # gives the same zip and the store keeps it once.
+    members = []
+    for root, dirs, files in os.walk(moddir):
+        dirs.sort()
+        for name in sorted(files) + [d for d in dirs if os.path.islink(os.path.join(root, d))]:
+            path = os.path.join(root, name)
+            arcname = os.path.relpath(path, moddir)
+            if arcname not in MODULE_FLAGS:
+                members.append((path, arcname))
+    with zipfile.ZipFile(destination, "w", zipfile.ZIP_DEFLATED) as archive:
+        for arcname, data in [(MODULE_BINARY, MODULE_INSTALLER),
+                              ("META-INF/com/google/android/updater-script", "#MAGISK\n")]:
+            info = zipfile.ZipInfo(arcname, (1980, 1, 1, 0, 0, 0))
+            info.external_attr = 0o100755 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, data)
+        for path, arcname in sorted(members, key=lambda member: member[1]):
+            mode = os.lstat(path).st_mode
+            info = zipfile.ZipInfo(arcname, (1980, 1, 1, 0, 0, 0))
+            info.external_attr = mode << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            if stat.S_ISLNK(mode):
+                archive.writestr(info, os.readlink(path))
+            else:
+                with open(path, "rb") as handle:
+                    archive.writestr(info, handle.read())
+
+
+def export_modules(modids=None):
+    import tempfile
+    modules_dir = os.path.join(xdg_data_home(), "waydroid", "data", "adb", "modules")
+    installed = sorted(name for name in os.listdir(modules_dir)
+                       if os.path.isfile(os.path.join(modules_dir, name, "module.prop")))
+    for modid in modids or []:
+        if modid not in installed:
+            logging.error("'%s' is not an installed Magisk module" % modid)
             return
-        logging.info("Removing '%s' Magisk module" % modname)
-        while os.path.isdir(os.path.join(modpath, modname)):
-            shutil.rmtree(os.path.join(modpath, modname))
-        logging.info("'%s' Magisk module has been removed" % modname)
-        restart_session_if_needed()
+    exported = []
+    os.makedirs(MODULE_STORE, exist_ok=True)
+    for modid in modids or installed:
+        moddir = os.path.join(modules_dir, modid)
+        props = read_module_prop(os.path.join(moddir, "module.prop"))
+        # The zip stored at install time runs customize.sh again, a packed
+        # one only has the files: no empty dirs, modes or contexts it set.
+        stored = sorted((entry["added"], digest)
+                        for digest, entry in read_module_store()["modules"].items()
+                        if entry["id"] == modid and
+                        entry.get("versionCode") == props.get("versionCode"))
+        if stored:
+            digest, added = stored[0][1], False
+        else:
+            with tempfile.TemporaryDirectory(dir=MODULE_STORE) as tmpdir:
+                path = os.path.join(tmpdir, "%s.zip" % modid)
+                pack_module(moddir, path)
+                digest, added = store_module(path, props)
+        logging.info("%s %s (%s): %s" % (modid, props.get("version"), digest[:12],
+                                         "exported" if added else "already in the store"))
+        exported.append(dict(props, sha256=digest))
+    return exported
 
 
 # Installer
 
 def is_installed():
+    inst = instance()
     if is_running():
-        magisk_dir = os.path.join(WAYDROID_DIR, "rootfs", "system", "etc", "init", "magisk")
+        magisk_dir = os.path.join(inst.waydroid_dir, "rootfs", "system", "etc", "init", "magisk")
     elif has_overlay():
         magisk_dir = os.path.join(
-            WAYDROID_DIR, "overlay/system/etc/init/magisk")
+            inst.waydroid_dir, "overlay/system/etc/init/magisk")
     else:
         with SystemMount():
             magisk_dir = os.path.join(
-                WAYDROID_DIR, "overlay/system/etc/init/magisk")
+                inst.waydroid_dir, "overlay/system/etc/init/magisk")
             return os.path.exists(magisk_dir)
     return os.path.isdir(magisk_dir)
 
 def is_set_up():
+    import filecmp
+    inst = instance()
     magisk_init = os.path.join(
-        MAGISK_OVERLAY, "magisk%s" % get_arch()[-1])
+        inst.magisk_overlay, "magisk%s" % get_arch()[-1])
     if not has_overlay():
         magisk_init = os.path.join(
-            WAYDROID_DIR, "rootfs", "system", "etc", "init", "magisk",
+            inst.waydroid_dir, "rootfs", "system", "etc", "init", "magisk",
             "magisk%s" % get_arch()[-1])
     magisk_data = os.path.join(xdg_data_home(
     ), "waydroid", "data", "adb", "magisk", "magisk%s" % get_arch()[-1])
@@ -588,9 +1215,11 @@ def is_set_up():
         magisk_init, magisk_data, shallow=False)
 
 
-def backup_bootanim():
+def backup_bootanim(init_dir=None):
+    import gzip
+    init_dir = init_dir or instance().init_overlay
     logging.info("Backing up bootanim.rc")
-    with open(os.path.join(INIT_OVERLAY, "bootanim.rc"), "w+") as handle:
+    with open(os.path.join(init_dir, "bootanim.rc"), "w+") as handle:
         handle.write("service bootanim /system/bin/bootanimation\n")
         handle.write("\tclass core animation\n")
         handle.write("\tuser graphics\n")
@@ -600,12 +1229,12 @@ def backup_bootanim():
         handle.write("\tioprio rt 0\n")
         handle.write("\ttask_profiles MaxPerformance\n")
         handle.write("\n")
-    with open(os.path.join(INIT_OVERLAY, "bootanim.rc"), "rb") as handle:
-        with gzip.open(os.path.join(INIT_OVERLAY, "bootanim.rc.gz"), "wb") as ghandle:
+    with open(os.path.join(init_dir, "bootanim.rc"), "rb") as handle:
+        with gzip.open(os.path.join(init_dir, "bootanim.rc.gz"), "wb") as ghandle:
             ghandle.writelines(handle)
 
 
-def patch_bootanim(bits):
+def patch_bootanim(bits, init_dir=None, boottime=False):
     logging.info("Patching bootanim.rc")
 
     x = ''.join(
@@ -616,23 +1245,43 @@ def patch_bootanim(bits):
         random.choice(string.ascii_letters + string.digits)
         for _ in range(15)
     )
+    z = ''.join(
+        random.choice(string.ascii_letters + string.digits)
+        for _ in range(15)
+    )
+
+    init_dir = init_dir or instance().init_overlay
+    with open(os.path.join(init_dir, "bootanim.rc"), "a") as handle:
+        def stamp(stage):
+            if boottime:
+                handle.write(
+                    "\texec u:r:su:s0 root root -- /system/bin/sh /system/etc/init/magisk/boottime.sh %s\n" % stage)
 
-    with open(os.path.join(INIT_OVERLAY, "bootanim.rc"), "a") as handle:
         handle.write("\n")
+        if boottime:
+            handle.write("on init\n")
+            stamp("init")
+            handle.write("\n\n")
         handle.write("on post-fs-data\n")
+        stamp("post-fs-data")
         handle.write("\tstart logd\n")
         handle.write(
             "\texec u:r:su:s0 root root -- /system/etc/init/magisk/magisk%s --auto-selinux --setup-sbin /system/etc/init/magisk\n" % str(bits))
+        stamp("setup-sbin")
         handle.write(
             "\texec u:r:su:s0 root root -- /system/etc/init/magisk/magiskpolicy --live --magisk \"allow * magisk_file lnk_file *\"\n")
+        stamp("policy")
         handle.write("\tmkdir /sbin/.magisk 700\n")
         handle.write("\tmkdir /sbin/.magisk/mirror 700\n")
         handle.write("\tmkdir /sbin/.magisk/block 700\n")
         handle.write(
             "\tcopy /system/etc/init/magisk/config /sbin/.magisk/config\n")
         handle.write("\trm /dev/.magisk_unblock\n")
+        if boottime:
+            handle.write("\tstart %s\n" % z)
         handle.write("\tstart %s\n" % x)
         handle.write("\twait /dev/.magisk_unblock 40\n")
+        stamp("unblock")
         handle.write("\trm /dev/.magisk_unblock\n")
         handle.write("\n\n")
 
@@ -651,10 +1300,27 @@ def patch_bootanim(bits):
         handle.write("\toneshot\n")
         handle.write("\n\n")
 
+        if boottime:
+            handle.write(
+                "service %s /system/bin/sh /system/etc/init/magisk/module_probe.sh\n" % z)
+            handle.write("\tuser root\n")
+            handle.write("\tseclabel u:r:su:s0\n")
+            handle.write("\toneshot\n")
+            handle.write("\n\n")
+
+            handle.write("on property:init.svc.%s=running\n" % y)
+            stamp("service-start")
+            handle.write("\n\n")
+            handle.write("on property:init.svc.%s=stopped\n" % y)
+            stamp("service-done")
+            handle.write("\n\n")
+
         handle.write("on property:sys.boot_completed=1\n")
+        stamp("boot-completed")
         handle.write("\tmkdir /data/adb/magisk 755\n")
         handle.write(
             "\texec u:r:su:s0 root root -- /sbin/magisk --auto-selinux --boot-complete\n")
+        stamp("boot-complete-done")
         handle.write("\n\n")
 
         handle.write("on property:init.svc.zygote=restarting\n")
@@ -668,117 +1334,679 @@ def patch_bootanim(bits):
         handle.write("\n")
 
 
-def install(arch, bits, magisk_channel, workdir=None,
-            restart_after=True, with_manager=False, apk_path=None):
+def sha256sum(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_magisk_version(util_functions):
+    version = None
+    with open(util_functions, "r") as handle:
+        for line in handle:
+            match = re.match("MAGISK_VER=['\"]?([^'\"\\s]+)", line)
+            if match:
+                version = match.group(1)
+                break
+    return version
+
+
+def bundle_file(channel, version, arch, manager=False):
+    return os.path.join(BUNDLE_DIR, "%s-%s-%s%s.tar.gz" % (
+        channel, version, arch, "-manager" if manager else ""))
+
+
+def installed_version(manifest):
+    # The version of the channel metadata when installed from a channel, it
+    # may be written differently than the MAGISK_VER of util_functions.sh.
+    return manifest.get("channel_version") or manifest.get("version")
+
+
+def installed_members(init_dir=None):
+    init_dir = init_dir or instance().init_overlay
+    magisk_dir = os.path.join(init_dir, "magisk")
+    members = []
+    for name in sorted(os.listdir(magisk_dir)):
+        members.append((os.path.join(magisk_dir, name), "magisk/%s" % name))
+    for name in ["bootanim.rc", "bootanim.rc.gz"]:
+        members.append((os.path.join(init_dir, name), name))
+    return members
+
+
+def build_manifest(version, arch, bits, magisk_channel, with_manager,
+                   init_dir=None, channel_version=None):
+    manifest = {
+        "format": 1,
+        "version": version,
+        "channel_version": channel_version,
+        "arch": arch,
+        "bits": bits,
+        "channel": magisk_channel,
+        "manager": with_manager,
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "files": {},
+    }
+    for path, arcname in installed_members(init_dir):
+        manifest["files"][arcname] = sha256sum(path)
+    return manifest
+
+
+def save_bundle(manifest, init_dir=None):
+    import tarfile
+    if not os.path.isdir(BUNDLE_DIR):
+        os.makedirs(BUNDLE_DIR)
+    destination = bundle_file(manifest["channel"], installed_version(manifest),
+                              manifest["arch"], manifest.get("manager"))
+    tmp = "%s.%s.%s.tmp" % (destination, os.getpid(), threading.get_ident())
+    with tarfile.open(tmp, "w:gz") as handle:
+        data = json.dumps(manifest, indent=2).encode()
+        info = tarfile.TarInfo("manifest.json")
+        info.size = len(data)
+        info.mtime = int(time.time())
+        handle.addfile(info, io.BytesIO(data))
+        for path, arcname in installed_members(init_dir):
+            handle.add(path, arcname=arcname)
+    os.replace(tmp, destination)
+    logging.info("Saved install bundle: %s" % destination)
+    return destination
+
+
+def unpack_bundle(path, arch, init_dir=None):
+    import tarfile
+    init_dir = init_dir or instance().init_overlay
+    magisk_dir = os.path.join(init_dir, "magisk")
+    with tarfile.open(path, "r:*") as handle:
+        manifest = json.load(handle.extractfile("manifest.json"))
+        if manifest.get("arch") != arch:
+            logging.error("Bundle is for %s, this device is %s" %
+                          (manifest.get("arch"), arch))
+            return None
+        # Cached bundles are looked up by name, which has to match what
+        # they contain.
+        expected = bundle_file(manifest.get("channel"), installed_version(manifest),
+                               arch, manifest.get("manager"))
+        if os.path.dirname(os.path.abspath(path)) == BUNDLE_DIR and \
+                os.path.abspath(path) != expected:
+            logging.error("Bundle %s holds %s %s, not what its name says" %
+                          (path, manifest.get("channel"), installed_version(manifest)))
+            return None
+        if not os.path.exists(magisk_dir):
+            os.makedirs(magisk_dir)
+        unpacked = set()
+        for member in handle.getmembers():
+            if member.name not in manifest["files"] or not member.isfile():
+                continue
+            if member.name.startswith("magisk/"):
+                dest = os.path.join(magisk_dir, os.path.basename(member.name))
+            else:
+                dest = os.path.join(init_dir, os.path.basename(member.name))
+            digest = hashlib.sha256()
+            with handle.extractfile(member) as source, open(dest, "wb") as target:
+                for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                    digest.update(chunk)
+                    target.write(chunk)
+            if digest.hexdigest() != manifest["files"][member.name]:
+                logging.error("Bundle file %s is corrupt" % member.name)
+                return None
+            os.chmod(dest, member.mode & 0o777)
+            unpacked.add(member.name)
+    missing = sorted(set(manifest["files"]) - unpacked)
+    if missing:
+        logging.error("Bundle is missing %s" % ", ".join(missing))
+        return None
+    return manifest
+
+
+def write_install_record(manifest):
+    record = instance().install_record
+    tmp = "%s.%s.tmp" % (record, os.getpid())
+    with open(tmp, "w") as handle:
+        json.dump(manifest, handle, indent=2)
+    os.replace(tmp, record)
+
+
+def read_install_record():
+    try:
+        with open(instance().install_record, "r") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+@shared
+def verify():
+    inst = instance()
     if not is_root():
         logging.error("This command needs to be ran as a priviliged user!")
         return
-    if is_installed():
-        logging.error("Kitsune Mask already installed!")
+    record = read_install_record()
+    if not record:
+        logging.error("No install record found, reinstall Kitsune Mask to create one")
         return
-    if magisk_channel == "release":
-        logging.info("Release channel does not exist, defaulting to canary")
-        magisk_channel == "canary"
-    stop_session_if_needed()
+    if is_running() and not has_overlay():
+        return verify_files(os.path.join(
+            inst.waydroid_dir, "rootfs", "system", "etc", "init"), record)
     with SystemMount() as mount:
         if not mount:
-            logging.error(
-                "Failed to mount rootfs. Make sure Waydroid is stopped during the installation.")
+            logging.error("Failed to mount rootfs")
             return
-        if workdir and not os.path.exists(workdir):
-            os.makedirs(workdir)
-        with tempfile.TemporaryDirectory(dir=workdir) as tempdir:
-            if not apk_path:
-                magisk = download_json(
-                    "https://raw.githubusercontent.com/HuskyDG/magisk-files/main/%s.json" % magisk_channel,
-                    "Kitsune Mask channels")
-                logging.info("Downloading Kitsune Mask: %s-%s" % (magisk_channel, magisk["magisk"]["version"]))
-                download_obj(magisk["magisk"]["link"], tempdir, "magisk-delta.apk")
-            else:
-                shutil.copyfile(apk_path, os.path.join(tempdir, "magisk-delta.apk"))
-            logging.info("Extracting Kitsune Mask")
-            with zipfile.ZipFile(os.path.join(tempdir, "magisk-delta.apk")) as handle:
-                handle.extractall(tempdir)
-            logging.info("Installing Kitsune Mask")
-            libs = os.path.join(tempdir, "lib", arch)
-            if not os.path.exists(MAGISK_OVERLAY):
-                os.makedirs(MAGISK_OVERLAY)
-            for lib in os.listdir(libs):
-                shutil.copyfile(
-                    os.path.join(libs, lib),
-                    os.path.join(MAGISK_OVERLAY, re.match("lib(.*)\\.so", lib).group(1)),
-                )
-                os.chmod(
-                    os.path.join(MAGISK_OVERLAY, re.match("lib(.*)\\.so", lib).group(1)),
-                    0o775,
-                )
-            if bits == 64:
-                if arch == "arm64-v8a":
-                    magisk32 = os.path.join(
-                        tempdir, "lib", "armeabi-v7a", "libmagisk32.so")
-                elif arch == "x86_64":
-                    magisk32 = os.path.join(
-                        tempdir, "lib", "x86", "libmagisk32.so")
-                shutil.copyfile(magisk32, os.path.join(MAGISK_OVERLAY, "magisk32"))
-                os.chmod(os.path.join(MAGISK_OVERLAY, "magisk32"), 0o775)
-            assets = os.path.join(tempdir, "assets")
-            extra_copy = ["util_functions.sh", "addon.d.sh", "boot_patch.sh"]
-            for extra in extra_copy:
-                shutil.copyfile(os.path.join(assets, extra),
-                                os.path.join(MAGISK_OVERLAY, extra))
-            if with_manager:
-                shutil.copyfile(os.path.join(tempdir, "magisk-delta.apk"),
-                                os.path.join(MAGISK_OVERLAY, "magisk.apk"))
-
-            backup_bootanim()
-            patch_bootanim(bits)
-            logging.info("Finishing installation")
-            if not os.path.exists(os.path.join(OVERLAY, "sbin")):
-                os.makedirs(os.path.join(OVERLAY, "sbin"))
-            if not os.path.exists(os.path.join(OVERLAY, "system/addon.d")):
-                os.makedirs(os.path.join(OVERLAY, "system/addon.d"))
-    if restart_after:
-        restart_session_if_needed()
-    logging.info("Done")
-    logging.info(
-        "Run waydroid_magisk setup after waydroid starts again or install Kitsune Mask Manager")
+        return verify_files(inst.init_overlay, record)
+
+
+def verify_files(init_dir, record):
+    problems = 0
+    for arcname, digest in sorted(record["files"].items()):
+        path = os.path.join(init_dir, *arcname.split("/"))
+        if not os.path.isfile(path):
+            logging.error("Missing: %s" % path)
+            problems += 1
+        elif sha256sum(path) != digest:
+            logging.error("Modified: %s" % path)
+            problems += 1
+    if problems:
+        logging.error("%s of %s Kitsune Mask files failed verification" %
+                      (problems, len(record["files"])))
+        return False
+    logging.info("Kitsune Mask %s (%s): %s files verified" %
+                 (record.get("version"), record.get("arch"), len(record["files"])))
+    return True
 
 
-def update(arch, bits, magisk_channel, restart_after=False,
-           workdir=None, with_manager=False, apk_path=None):
-    uninstalled = uninstall(restart_after=False)
-    if uninstalled:
-        installed = install(arch, bits, magisk_channel,
-                            workdir=workdir, with_manager=with_manager, apk_path=apk_path)
-        if installed:
-            logging.info(
-                "Manually update Magisk Manager after booting Waydroid.")
+def install_apk(apk, tempdir, arch, bits, with_manager, init_dir=None):
+    import zipfile
+    init_dir = init_dir or instance().init_overlay
+    magisk_dir = os.path.join(init_dir, "magisk")
+    logging.info("Extracting Kitsune Mask")
+    with zipfile.ZipFile(apk) as handle:
+        handle.extractall(tempdir)
+    logging.info("Installing Kitsune Mask")
+    libs = os.path.join(tempdir, "lib", arch)
+    if not os.path.exists(magisk_dir):
+        os.makedirs(magisk_dir)
+    for lib in os.listdir(libs):
+        shutil.copyfile(
+            os.path.join(libs, lib),
+            os.path.join(magisk_dir, re.match("lib(.*)\\.so", lib).group(1)),
+        )
+        os.chmod(
+            os.path.join(magisk_dir, re.match("lib(.*)\\.so", lib).group(1)),
+            0o775,
+        )
+    if bits == 64:
+        if arch == "arm64-v8a":
+            magisk32 = os.path.join(
+                tempdir, "lib", "armeabi-v7a", "libmagisk32.so")
+        elif arch == "x86_64":
+            magisk32 = os.path.join(
+                tempdir, "lib", "x86", "libmagisk32.so")
+        shutil.copyfile(magisk32, os.path.join(magisk_dir, "magisk32"))
+        os.chmod(os.path.join(magisk_dir, "magisk32"), 0o775)
+    assets = os.path.join(tempdir, "assets")
+    extra_copy = ["util_functions.sh", "addon.d.sh", "boot_patch.sh"]
+    for extra in extra_copy:
+        shutil.copyfile(os.path.join(assets, extra),
+                        os.path.join(magisk_dir, extra))
+    if with_manager:
+        shutil.copyfile(apk, os.path.join(magisk_dir, "magisk.apk"))
+
+    backup_bootanim(init_dir)
+    patch_bootanim(bits, init_dir)
+    return read_magisk_version(os.path.join(assets, "util_functions.sh"))
+
+
+def commit_staging(staging):
+    # Switch the staged files into place with renames, the old magisk dir is
+    # moved aside first so the overlay never holds a partial install.
+    inst = instance()
+    old = os.path.join(staging, ".old")
+    os.makedirs(inst.init_overlay, exist_ok=True)
+    if os.path.lexists(inst.magisk_overlay):
+        os.rename(inst.magisk_overlay, old)
+    os.rename(os.path.join(staging, "magisk"), inst.magisk_overlay)
+    for name in ["bootanim.rc.gz", "bootanim.rc"]:
+        os.replace(os.path.join(staging, name),
+                   os.path.join(inst.init_overlay, name))
+
+
+# Generations
+
+GENERATIONS_KEEP = 3
+
+
+def snapshot_paths():
+    inst = instance()
+    paths = [
+        inst.magisk_overlay,
+        os.path.join(inst.init_overlay, "bootanim.rc"),
+        os.path.join(inst.init_overlay, "bootanim.rc.gz"),
+        os.path.join(inst.overlay, "sbin"),
+        os.path.join(inst.overlay, "system", "addon.d"),
+        os.path.join(inst.waydroid_dir, "bootanim.rc.gz"),
+        inst.install_record,
+        inst.magisk_overlay_rw,
+    ]
+    paths.extend(mfile for mfile in inst.magisk_files
+                 if not mfile.startswith(os.path.join(inst.magisk_overlay_rw, "")))
+    return [os.path.relpath(path, inst.waydroid_dir) for path in paths]
+
+
+def reflink(source, dest):
+    import fcntl
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.remove(dest)
+            raise
+
+
+def snapshot_file(source, dest, hardlink):
+    # Reflinks are free and safe, hardlinks are only used for files we
+    # replace by rename and never rewrite in place (not overlay_rw).
+    with contextlib.suppress(OSError):
+        reflink(source, dest)
+        shutil.copymode(source, dest)
+        return
+    if hardlink:
+        with contextlib.suppress(OSError):
+            os.link(source, dest)
+            return
+    clone_file(source, dest)
+    shutil.copymode(source, dest)
+
+
+def snapshot_tree(source, dest, hardlink):
+    for root, _dirs, names in os.walk(source):
+        target = os.path.join(dest, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+        shutil.copymode(root, target)
+        for name in names:
+            snapshot_file(os.path.join(root, name),
+                          os.path.join(target, name), hardlink)
+
+
+def list_generations():
+    generations_dir = instance().generations_dir
+    if not os.path.isdir(generations_dir):
+        return []
+    result = []
+    for name in sorted(os.listdir(generations_dir)):
+        path = os.path.join(generations_dir, name, "generation.json")
+        with contextlib.suppress(OSError, ValueError):
+            with open(path, "r") as handle:
+                generation = json.load(handle)
+            generation["path"] = os.path.dirname(path)
+            result.append(generation)
+    return result
 
 
-def setup():
-    if not is_root():
-        logging.error("This command needs to be ran as a priviliged user!")
-        return
-    if not is_running():
-        logging.error("Waydroid session is not running")
-        return
-    if not is_installed():
-        logging.error("Kitsune Mask is not installed")
-        return
-    su(["rm", "-rf", "/data/adb/magisk"])
-    su(["mkdir", "-p", "/data/adb/magisk"])
-    su(["chmod", "700", "/data/adb"])
-    su(["cp", "/system/etc/init/magisk/*", "/data/adb/magisk"])
-    su(["chmod", "-R", "755", "/data/adb/magisk/"])
-    su(["chown", "-R", "0:0", "/data/adb/magisk"])
-    restart_session_if_needed()
+def snapshot(reason):
+    inst = instance()
+    name = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    generation = os.path.join(inst.generations_dir, name)
+    files = os.path.join(generation, "files")
+    os.makedirs(files)
+    state = {}
+    for rel in snapshot_paths():
+        source = os.path.join(inst.waydroid_dir, rel)
+        dest = os.path.join(files, rel)
+        hardlink = not rel.startswith("overlay_rw")
+        if os.path.isdir(source) and not os.path.islink(source):
+            snapshot_tree(source, dest, hardlink)
+            state[rel] = "dir"
+        elif os.path.lexists(source):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            snapshot_file(source, dest, hardlink)
+            state[rel] = "file"
+        else:
+            state[rel] = "absent"
+    record = read_install_record() or {}
+    with open(os.path.join(generation, "generation.json"), "w") as handle:
+        json.dump({"name": name, "reason": reason,
+                   "version": installed_version(record), "paths": state},
+                  handle, indent=2)
+    for old in list_generations()[:-GENERATIONS_KEEP]:
+        shutil.rmtree(old["path"])
+    return generation
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def restore(generation):
+    inst = instance()
+    with open(os.path.join(generation, "generation.json"), "r") as handle:
+        state = json.load(handle)["paths"]
+    files = os.path.join(generation, "files")
+    for rel, kind in state.items():
+        target = os.path.join(inst.waydroid_dir, rel)
+        if kind == "absent":
+            remove_path(target)
+            continue
+        source = os.path.join(files, rel)
+        tmp = os.path.join(os.path.dirname(target),
+                           ".%s.restore" % os.path.basename(target))
+        remove_path(tmp)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if kind == "dir":
+            snapshot_tree(source, tmp, False)
+            old = os.path.join(os.path.dirname(target),
+                               ".%s.old" % os.path.basename(target))
+            remove_path(old)
+            if os.path.lexists(target):
+                os.rename(target, old)
+            os.rename(tmp, target)
+            remove_path(old)
+        else:
+            snapshot_file(source, tmp, False)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            os.replace(tmp, target)
 
 
-def uninstall(restart_after=True):
+@exclusive
+def rollback(generation_name=None, restart_after=True):
     if not is_root():
         logging.error("This command needs to be ran as a priviliged user!")
         return
-    if not is_installed():
+    generations = list_generations()
+    if generation_name:
+        generations = [gen for gen in generations if gen["name"] == generation_name]
+    if not generations:
+        logging.error("No Kitsune Mask generation to roll back to")
+        return
+    generation = generations[-1]
+    stop_session_if_needed()
+    with SystemMount() as mount:
+        if not mount:
+            logging.error(
+                "Failed to mount rootfs. Make sure Waydroid is stopped during the rollback.")
+            return
+        logging.info("Restoring generation %s (%s, Kitsune Mask %s)" % (
+            generation["name"], generation["reason"],
+            generation.get("version") or "not installed"))
+        restore(generation["path"])
+    shutil.rmtree(generation["path"])
+    if restart_after:
+        restart_session_if_needed()
+    logging.info("Done")
+    return True
+
+
+def stage_install(staging, arch, bits, magisk_channel, magisk, workdir,
+                  with_manager, apk_path, bundle_path, boottime=False):
+    manifest = build_staging(
+        staging, arch, bits, magisk_channel, magisk, workdir,
+        with_manager, apk_path, bundle_path)
+    if manifest and bool(manifest.get("boottime")) != boottime:
+        instrument_bootanim(manifest, staging, boottime)
+    return manifest
+
+
+def build_staging(staging, arch, bits, magisk_channel, magisk, workdir,
+                  with_manager, apk_path, bundle_path):
+    import tempfile
+    if bundle_path:
+        logging.info("Installing Kitsune Mask from bundle: %s" % bundle_path)
+        return unpack_bundle(bundle_path, arch, staging)
+    if workdir and not os.path.exists(workdir):
+        os.makedirs(workdir)
+    with tempfile.TemporaryDirectory(dir=workdir) as tempdir:
+        apk = os.path.join(tempdir, "magisk-delta.apk")
+        if magisk:
+            logging.info("Downloading Kitsune Mask: %s-%s" % (magisk_channel, magisk["magisk"]["version"]))
+            download_obj(magisk["magisk"]["link"], tempdir, "magisk-delta.apk",
+                         magisk["magisk"].get("sha256"))
+        else:
+            shutil.copyfile(apk_path, apk)
+        version = install_apk(apk, tempdir, arch, bits, with_manager, staging)
+    manifest = build_manifest(
+        version, arch, bits, magisk_channel, with_manager, staging,
+        magisk["magisk"]["version"] if magisk else None)
+    # A custom apk isn't saved, its MAGISK_VER could be a channel version.
+    if version and magisk:
+        try:
+            save_bundle(manifest, staging)
+        except OSError as exc:
+            logging.error("Failed to save install bundle: %s" % exc)
+    return manifest
+
+
+@exclusive
+def install(arch, bits, magisk_channel, workdir=None,
+            restart_after=True, with_manager=False, apk_path=None,
+            bundle_path=None, boottime=False, channel_url=None, magisk=None):
+    inst = instance()
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    if is_installed():
+        logging.error("Kitsune Mask already installed!")
+        return
+    if magisk_channel == "release":
+        logging.info("Release channel does not exist, defaulting to canary")
+        magisk_channel == "canary"
+    if magisk is None:
+        magisk, bundle_path = resolve_install_source(
+            arch, magisk_channel, with_manager, apk_path, bundle_path, channel_url)
+    stop_session_if_needed()
+    with SystemMount() as mount:
+        if not mount:
+            logging.error(
+                "Failed to mount rootfs. Make sure Waydroid is stopped during the installation.")
+            return
+        # Everything is built in a staging dir on the same filesystem and
+        # renamed into place once complete.
+        staging = os.path.join(inst.overlay, ".waydroid_magisk_staging")
+        remove_path(staging)
+        os.makedirs(staging)
+        try:
+            manifest = stage_install(
+                staging, arch, bits, magisk_channel, magisk, workdir,
+                with_manager, apk_path, bundle_path, boottime)
+            if not manifest:
+                return
+            logging.info("Finishing installation")
+            commit_staging(staging)
+        finally:
+            remove_path(staging)
+        write_install_record(manifest)
+        if not os.path.exists(os.path.join(inst.overlay, "sbin")):
+            os.makedirs(os.path.join(inst.overlay, "sbin"))
+        if not os.path.exists(os.path.join(inst.overlay, "system/addon.d")):
+            os.makedirs(os.path.join(inst.overlay, "system/addon.d"))
+    if restart_after:
+        restart_session_if_needed()
+    logging.info("Done")
+    logging.info(
+        "Run waydroid_magisk setup after waydroid starts again or install Kitsune Mask Manager")
+    return True
+
+
+@exclusive
+def resolve_install_source(arch, magisk_channel, with_manager, apk_path,
+                           bundle_path, channel_url):
+    # Returns the channel metadata and the bundle to install from. Fetched
+    # before Waydroid is stopped, with the apk when no bundle is cached, so a
+    # network failure costs neither downtime nor a rollback.
+    if apk_path or bundle_path:
+        return None, bundle_path
+    json_url = channel_json_url(magisk_channel, channel_url)
+    magisk = resolve_links(
+        download_json(json_url, "Kitsune Mask channels"), json_url)
+    cached = bundle_file(magisk_channel, magisk["magisk"]["version"], arch, with_manager)
+    if os.path.isfile(cached):
+        return magisk, cached
+    cache_obj(magisk["magisk"]["link"], "magisk-delta.apk",
+              magisk["magisk"].get("sha256"))
+    return magisk, None
+
+
+@exclusive
+def install_transactional(arch, bits, magisk_channel, restart_after=True,
+                          **kwargs):
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    if is_installed():
+        logging.error("Kitsune Mask already installed!")
+        return
+    kwargs["magisk"], kwargs["bundle_path"] = resolve_install_source(
+        arch, magisk_channel, kwargs.get("with_manager"), kwargs.get("apk_path"),
+        kwargs.get("bundle_path"), kwargs.get("channel_url"))
+    installed = transactional("install", lambda: install(
+        arch, bits, magisk_channel, restart_after=False, **kwargs))
+    if installed and restart_after:
+        restart_session_if_needed()
+    return installed
+
+
+@exclusive
+def transactional(reason, action):
+    # Runs action() against a snapshot of the current Kitsune Mask files,
+    # restoring it if the action fails or raises. The snapshot, the action
+    # and the restore all run under the same exclusive lock.
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    stop_session_if_needed()
+    with SystemMount() as mount:
+        if not mount:
+            logging.error(
+                "Failed to mount rootfs. Make sure Waydroid is stopped during the installation.")
+            return
+        generation = snapshot(reason)
+        try:
+            result = action()
+        except BaseException:
+            logging.error("%s failed, restoring the previous Kitsune Mask files" %
+                          reason.capitalize())
+            restore(generation)
+            raise
+        if not result:
+            logging.error("%s failed, restoring the previous Kitsune Mask files" %
+                          reason.capitalize())
+            restore(generation)
+    return result
+
+
+@exclusive
+def update(arch, bits, magisk_channel, restart_after=False,
+           workdir=None, with_manager=False, apk_path=None, bundle_path=None,
+           channel_url=None):
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    if not is_installed():
+        logging.error("Kitsune Mask is not installed!")
+        return
+    boottime = bool((read_install_record() or {}).get("boottime"))
+    magisk, bundle_path = resolve_install_source(
+        arch, magisk_channel, with_manager, apk_path, bundle_path, channel_url)
+
+    def action():
+        return uninstall(restart_after=False) and install(
+            arch, bits, magisk_channel, workdir=workdir,
+            restart_after=False, with_manager=with_manager,
+            apk_path=apk_path, bundle_path=bundle_path, boottime=boottime,
+            channel_url=channel_url, magisk=magisk)
+
+    installed = transactional("update", action)
+    if installed:
+        if restart_after:
+            restart_session_if_needed()
+        logging.info(
+            "Manually update Magisk Manager after booting Waydroid.")
+    return installed
+
+
+def update_status(refresh=False, channel_url=None):
+    record = read_install_record()
+    if not record:
+        logging.error("No install record found, reinstall Kitsune Mask to create one")
+        return
+    ttl = 0 if refresh else CHANNEL_CACHE_TTL
+    try:
+        channels = gather(*(
+            cached_json_async(channel_json_url(channel, channel_url),
+                              "Kitsune Mask %s channel" % channel, ttl)
+            for channel in MAGISK_CHANNELS))
+    except ValueError as exc:
+        logging.error(exc)
+        return
+    installed_channel = record.get("channel")
+    if installed_channel not in MAGISK_CHANNELS:
+        installed_channel = "canary"
+    versions = {channel: metadata.get("magisk", {}).get("version")
+                for channel, metadata in zip(MAGISK_CHANNELS, channels)}
+    latest = versions[installed_channel]
+    # Without the channel version (installed from an apk) there is nothing
+    # comparable, MAGISK_VER may be written differently: unknown, not newer.
+    comparable = bool(latest) and bool(record.get("channel_version"))
+    return {
+        "installed": installed_version(record),
+        "channel": installed_channel,
+        "channels": versions,
+        "update_available": latest != record["channel_version"] if comparable else None,
+    }
+
+
+def check_update(refresh=False, channel_url=None):
+    status = update_status(refresh, channel_url)
+    if not status:
+        return 1
+    print("Installed: %s (%s)" % (status["installed"], status["channel"]))
+    for channel in MAGISK_CHANNELS:
+        print("- %s | %s" % (channel, status["channels"][channel]))
+    if status["update_available"]:
+        logging.info("Update available: %s -> %s" % (
+            status["installed"], status["channels"][status["channel"]]))
+        return UPDATE_AVAILABLE
+    if status["update_available"] is None:
+        logging.info("Not installed from a channel, can't tell whether an update is available")
+        return 0
+    logging.info("Kitsune Mask is up to date")
+    return 0
+
+
+@exclusive
+def setup(restart_after=True):
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    if not is_running():
+        logging.error("Waydroid session is not running")
+        return
+    if not is_installed():
+        logging.error("Kitsune Mask is not installed")
+        return
+    with WaydroidFreezeUnfreeze():
+        su(["rm", "-rf", "/data/adb/magisk"])
+        su(["mkdir", "-p", "/data/adb/magisk"])
+        su(["chmod", "700", "/data/adb"])
+        su(["cp", "/system/etc/init/magisk/*", "/data/adb/magisk"])
+        su(["chmod", "-R", "755", "/data/adb/magisk/"])
+        su(["chown", "-R", "0:0", "/data/adb/magisk"])
+    if restart_after:
+        restart_session_if_needed()
+    return True
+
+
+@exclusive
+def uninstall(restart_after=True):
+    import gzip
+    inst = instance()
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    if not is_installed():
         logging.error("Kitsune Mask is not installed!")
         return
     stop_session_if_needed()
@@ -789,9 +2017,9 @@ def uninstall(restart_after=True):
             return
         logging.info("Removing Kitsune Mask")
         if not has_overlay():
-            shutil.copyfile(os.path.join(INIT_OVERLAY, "bootanim.rc.gz"),
-                            os.path.join(WAYDROID_DIR, "bootanim.rc.gz"))
-        for file in MAGISK_FILES:
+            shutil.copyfile(os.path.join(inst.init_overlay, "bootanim.rc.gz"),
+                            os.path.join(inst.waydroid_dir, "bootanim.rc.gz"))
+        for file in inst.magisk_files:
             if os.path.exists(file):
                 if os.path.isdir(file):
                     shutil.rmtree(file)
@@ -804,58 +2032,1050 @@ def uninstall(restart_after=True):
                 else:
                     os.remove(file)
 
-        if os.path.exists(MAGISK_OVERLAY):
-            if os.path.isdir(MAGISK_OVERLAY):
-                shutil.rmtree(MAGISK_OVERLAY)
+        if os.path.exists(inst.magisk_overlay):
+            if os.path.isdir(inst.magisk_overlay):
+                shutil.rmtree(inst.magisk_overlay)
             else:
-                os.remove(MAGISK_OVERLAY)
+                os.remove(inst.magisk_overlay)
 
-        if os.path.exists(MAGISK_OVERLAY_RW):
-            if os.path.isdir(MAGISK_OVERLAY_RW):
-                shutil.rmtree(MAGISK_OVERLAY_RW)
+        if os.path.exists(inst.magisk_overlay_rw):
+            if os.path.isdir(inst.magisk_overlay_rw):
+                shutil.rmtree(inst.magisk_overlay_rw)
             else:
-                os.remove(MAGISK_OVERLAY_RW)
+                os.remove(inst.magisk_overlay_rw)
 
         if has_overlay():
-            if os.path.exists(os.path.join(OVERLAY, "sbin")):
-                if os.path.isdir(os.path.join(OVERLAY, "sbin")):
-                    shutil.rmtree(os.path.join(OVERLAY, "sbin"))
+            if os.path.exists(os.path.join(inst.overlay, "sbin")):
+                if os.path.isdir(os.path.join(inst.overlay, "sbin")):
+                    shutil.rmtree(os.path.join(inst.overlay, "sbin"))
                 else:
-                    os.remove(os.path.join(OVERLAY, "sbin"))
+                    os.remove(os.path.join(inst.overlay, "sbin"))
 
-            if os.path.exists(os.path.join(OVERLAY, "system/addon.d")):
-                if os.path.isdir(os.path.join(OVERLAY, "system/addon.d")):
-                    shutil.rmtree(os.path.join(OVERLAY, "system/addon.d"))
+            if os.path.exists(os.path.join(inst.overlay, "system/addon.d")):
+                if os.path.isdir(os.path.join(inst.overlay, "system/addon.d")):
+                    shutil.rmtree(os.path.join(inst.overlay, "system/addon.d"))
                 else:
-                    os.remove(os.path.join(OVERLAY, "system/addon.d"))
+                    os.remove(os.path.join(inst.overlay, "system/addon.d"))
         else:
-            with gzip.open(os.path.join(WAYDROID_DIR, "bootanim.rc.gz"), "rb") as gzfile:
-                with open(os.path.join(INIT_OVERLAY, "bootanim.rc"), "wb") as rcfile:
+            # Written aside and renamed so snapshots hardlinking the old
+            # bootanim.rc are left untouched.
+            rcfile_path = os.path.join(inst.init_overlay, "bootanim.rc")
+            with gzip.open(os.path.join(inst.waydroid_dir, "bootanim.rc.gz"), "rb") as gzfile:
+                with open(rcfile_path + ".tmp", "wb") as rcfile:
                     shutil.copyfileobj(gzfile, rcfile)
-    os.remove(os.path.join(WAYDROID_DIR, "bootanim.rc.gz"))
+            os.replace(rcfile_path + ".tmp", rcfile_path)
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(inst.waydroid_dir, "bootanim.rc.gz"))
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(inst.install_record)
     if restart_after:
         restart_session_if_needed()
     logging.info("Done")
     return True
 
 
+# Boot time
+
+# Relative to the data dir of the container
+BOOTTIME_LOG = "adb/waydroid_magisk/boottime.log"
+BOOTTIME_HELPER = """#!/system/bin/sh
+mkdir -p /data/adb/waydroid_magisk
+read uptime idle < /proc/uptime
+echo "$1 $uptime" >> /data/%s
+""" % BOOTTIME_LOG
+# (name, from stage, to stage), stages are stamped by the instrumented
+# bootanim.rc. post-fs-data blocks init until Magisk unblocks it.
+BOOTTIME_SPANS = [
+    ("setup-sbin", "post-fs-data", "setup-sbin"),
+    ("policy patch", "setup-sbin", "policy"),
+    ("post-fs-data", "policy", "unblock"),
+    ("blocking total", "post-fs-data", "unblock"),
+    ("service", "service-start", "service-done"),
+    ("boot-complete", "boot-completed", "boot-complete-done"),
+    ("boot", "init", "boot-completed"),
+]
+UNBLOCK_TIMEOUT = 40
+MODULE_PROBE_LOG = "adb/waydroid_magisk/modules.log"
+# Polls /proc from post-fs-data until shortly after boot completed, logging
+# "start|end <pid>:<module>:<script> <uptime>" for the post-fs-data.sh and
+# service.sh processes of the modules.
+MODULE_PROBE = """#!/system/bin/sh
+LOG=/data/%s
+mkdir -p /data/adb/waydroid_magisk
+read uptime idle < /proc/uptime
+echo "boot $uptime" >> $LOG
+deadline=$((${uptime%%.*} + 300))
+running=""
+settled=0
+while [ $settled -lt 50 ] && [ ${uptime%%.*} -lt $deadline ]; do
+  current=$(grep -aoE '/data/adb/modules/[^/]+/(post-fs-data|service)[.]sh' /proc/[0-9]*/cmdline 2>/dev/null |
+    sed 's|^/proc/\\([0-9]*\\)/cmdline:/data/adb/modules/\\([^/]*\\)/\\(.*\\)[.]sh$|\\1:\\2:\\3|')
+  read uptime idle < /proc/uptime
+  for entry in $current; do
+    case " $running " in *" $entry "*) ;; *) echo "start $entry $uptime" >> $LOG ;; esac
+  done
+  for entry in $running; do
+    case " $current " in *" $entry "*) ;; *) echo "end $entry $uptime" >> $LOG ;; esac
+  done
+  running=$(echo $current)
+  if [ "$(getprop sys.boot_completed)" = 1 ]; then
+    settled=$((settled + 1))
+  fi
+  sleep 0.2
+done
+echo "stop $uptime" >> $LOG
+""" % MODULE_PROBE_LOG
+
+
+def instrument_bootanim(manifest, init_dir=None, enabled=True):
+    init_dir = init_dir or instance().init_overlay
+    helpers = {os.path.join(init_dir, "magisk", "boottime.sh"): BOOTTIME_HELPER,
+               os.path.join(init_dir, "magisk", "module_probe.sh"): MODULE_PROBE}
+    # Unlinked before being rewritten, generations may hardlink them.
+    for name in ["bootanim.rc", "bootanim.rc.gz"] + list(helpers):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(init_dir, name))
+    backup_bootanim(init_dir)
+    patch_bootanim(manifest["bits"], init_dir, boottime=enabled)
+    for helper, script in helpers.items() if enabled else []:
+        with open(helper, "w") as handle:
+            handle.write(script)
+        os.chmod(helper, 0o755)
+    manifest["boottime"] = enabled
+    manifest["files"] = {}
+    for path, arcname in installed_members(init_dir):
+        manifest["files"][arcname] = sha256sum(path)
+
+
+@exclusive
+def set_boottime(enabled, restart_after=True):
+    inst = instance()
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    record = read_install_record()
+    if not record:
+        logging.error("No install record found, reinstall Kitsune Mask to create one")
+        return
+    if bool(record.get("boottime")) == enabled:
+        logging.info("Boot time probe is already %s" %
+                     ("enabled" if enabled else "disabled"))
+        return True
+    stop_session_if_needed()
+    with SystemMount() as mount:
+        if not mount:
+            logging.error(
+                "Failed to mount rootfs. Make sure Waydroid is stopped during the installation.")
+            return
+        logging.info("%s the boot time probe" %
+                     ("Enabling" if enabled else "Disabling"))
+        instrument_bootanim(record, inst.init_overlay, enabled)
+        write_install_record(record)
+    if restart_after:
+        restart_session_if_needed()
+    logging.info("Done")
+    return True
+
+
+def boottime_log_path():
+    return container_data(BOOTTIME_LOG)
+
+
+def read_boottime_log(path):
+    # One "<stage> <uptime>" line per stamp, every boot starts with init.
+    boots = []
+    with open(path, "r") as handle:
+        for line in handle:
+            fields = line.split()
+            if len(fields) != 2:
+                continue
+            try:
+                stamp = float(fields[1])
+            except ValueError:
+                continue
+            if fields[0] == "init" or not boots:
+                boots.append({})
+            boots[-1].setdefault(fields[0], stamp)
+    return boots
+
+
+def boottime_spans(boot):
+    spans = {}
+    for name, start, end in BOOTTIME_SPANS:
+        if start in boot and end in boot:
+            spans[name] = boot[end] - boot[start]
+    if "boot" in spans and "blocking total" in spans:
+        spans["boot without Magisk (estimated)"] = (
+            spans["boot"] - spans["blocking total"])
+    return spans
+
+
+def boottime(last=5):
+    try:
+        path = boottime_log_path()
+    except KeyError:
+        logging.error("Waydroid session data not found")
+        return
+    if not os.path.isfile(path):
+        logging.error("No boot times recorded, enable the probe with waydroid_magisk boottime enable")
+        return
+    boots = [boottime_spans(boot) for boot in read_boottime_log(path)]
+    boots = [spans for spans in boots if spans][-last:]
+    if not boots:
+        logging.error("No complete boot recorded yet")
+        return
+    print("Boot stages over the last %d boot(s), seconds (mean | min | max):" % len(boots))
+    names = [span[0] for span in BOOTTIME_SPANS]
+    names.append("boot without Magisk (estimated)")
+    for name in names:
+        values = [spans[name] for spans in boots if name in spans]
+        if values:
+            print("- %s | %.2f | %.2f | %.2f" % (
+                name, sum(values) / len(values), min(values), max(values)))
+    timeouts = len([spans for spans in boots
+                    if spans.get("post-fs-data", 0) >= UNBLOCK_TIMEOUT])
+    if timeouts:
+        logging.warning("Magisk did not unblock post-fs-data in %d boot(s), init waited %ds" %
+                        (timeouts, UNBLOCK_TIMEOUT))
+    return True
+
+
+def read_module_probe(path):
+    # Seconds each module script ran per boot, {(module, script): seconds}.
+    # A script still running when the probe stopped counts until then and
+    # is listed in the "running" set of its boot.
+    boots = []
+    started = {}
+    with open(path, "r") as handle:
+        for line in handle:
+            fields = line.split()
+            try:
+                stamp = float(fields[-1])
+            except (ValueError, IndexError):
+                continue
+            if fields[0] == "boot" or not boots:
+                boots.append({"scripts": {}, "running": set()})
+                started = {}
+            boot = boots[-1]
+            if len(fields) == 3 and fields[0] == "start":
+                started[fields[1]] = stamp
+            elif len(fields) == 3 and fields[0] == "end" and fields[1] in started:
+                pid, modid, script = fields[1].split(":", 2)
+                key = (modid, script)
+                boot["scripts"][key] = boot["scripts"].get(key, 0) + \
+                    stamp - started.pop(fields[1])
+            elif fields[0] == "stop":
+                for entry, start in started.items():
+                    pid, modid, script = entry.split(":", 2)
+                    key = (modid, script)
+                    boot["scripts"][key] = boot["scripts"].get(key, 0) + stamp - start
+                    boot["running"].add(key)
+                started = {}
+    return boots
+
+
+def module_profile(last=5):
+    # post-fs-data.sh scripts run one after the other while init is blocked,
+    # service.sh scripts run in parallel, so modules are ranked by their
+    # post-fs-data time first.
+    path = container_data(MODULE_PROBE_LOG)
+    if not os.path.isfile(path):
+        raise ValueError("No module timings recorded, enable the probe with waydroid_magisk boottime enable")
+    boots = read_module_probe(path)[-last:]
+    modules = {}
+    for boot in boots:
+        for (modid, script), seconds in boot["scripts"].items():
+            entry = modules.setdefault(modid, {
+                "id": modid, "boots": 0, "post-fs-data": [], "service": [],
+                "running": False})
+            entry[script].append(seconds)
+            entry["running"] = entry["running"] or (modid, script) in boot["running"]
+        for modid in set(modid for modid, script in boot["scripts"]):
+            modules[modid]["boots"] += 1
+    profile = []
+    for entry in modules.values():
+        for script in ["post-fs-data", "service"]:
+            values = entry.pop(script)
+            entry[script] = {
+                "mean": sum(values) / len(values), "max": max(values)} if values else None
+        profile.append(entry)
+    profile.sort(key=lambda entry: (
+        -(entry["post-fs-data"] or {}).get("mean", 0),
+        -(entry["service"] or {}).get("mean", 0)))
+    return len(boots), profile
+
+
+def show_module_profile(count, profile):
+    if not profile:
+        logging.error("No module script ran in the recorded boots")
+        return
+    print("Module scripts over the last %d boot(s), seconds (mean | max):" % count)
+    for entry in profile:
+        columns = []
+        for script in ["post-fs-data", "service"]:
+            if entry[script]:
+                columns.append("%s %.2f | %.2f" % (
+                    script, entry[script]["mean"], entry[script]["max"]))
+        print("- %s: %s%s" % (entry["id"], ", ".join(columns),
+                              " (still running at the end of the probe)" if entry["running"] else ""))
+    return True
+
+
+def clear_boottime():
+    try:
+        for name in [BOOTTIME_LOG, MODULE_PROBE_LOG]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(container_data(name))
+    except KeyError:
+        logging.error("Waydroid session data not found")
+        return
+    return True
+
+
+# Su audit
+
+# Read host-side from the data dir of the container, the container doesn't
+# need to run. Cursors are kept per instance so every run only reads what is
+# new since the previous one.
+SU_AUDIT_CURSORS = os.path.join(DATA_DIR, "su_audit.json")
+SU_AUDIT_INTERVAL = 2
+_packages_list = {}
+
+
+def package_names():
+    # uid -> packages from data/system/packages.list, parsed again only when
+    # the file changes.
+    path = container_data("system", "packages.list")
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _packages_list.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    names = {}
+    with open(path, "r", errors="replace") as handle:
+        for line in handle:
+            fields = line.split()
+            if len(fields) > 1 and fields[1].isdigit():
+                names.setdefault(int(fields[1]), []).append(fields[0])
+    _packages_list[path] = (key, names)
+    return names
+
+
+def uid_package(uid, names):
+    # Apps of secondary users run as <user>*100000 + <app id>.
+    packages = names.get(uid) or names.get(uid % 100000)
+    return ",".join(sorted(packages)) if packages else None
+
+
+def find_sulogs():
+    # The su log is kept by the manager app, whose package name is random
+    # once it's hidden.
+    import glob
+    paths = glob.glob(container_data("data", "*", "databases", "sulogs.db"))
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def db_version(path):
+    # Changes whenever sqlite writes to the database or its WAL.
+    version = []
+    for name in [path, path + "-wal"]:
+        try:
+            stat = os.stat(name)
+            version.extend([stat.st_ino, stat.st_mtime_ns, stat.st_size])
+        except FileNotFoundError:
+            version.extend([0, 0, 0])
+    return version
+
+
+def query_db(path, query, args=()):
+    import sqlite3
+    connection = sqlite3.connect("file:%s?mode=ro" % path, uri=True, timeout=5)
+    try:
+        connection.row_factory = sqlite3.Row
+        return [dict(row) for row in connection.execute(query, args)]
+    finally:
+        connection.close()
+
+
+def read_su_cursors():
+    try:
+        with open(SU_AUDIT_CURSORS, "r") as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_su_cursors(cursors):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    tmp = "%s.%s.tmp" % (SU_AUDIT_CURSORS, os.getpid())
+    with open(tmp, "w") as handle:
+        json.dump(cursors, handle, indent=2, sort_keys=True)
+    os.replace(tmp, SU_AUDIT_CURSORS)
+
+
+def su_log_events(path, cursor, names):
+    # Only the rows after the cursor are read, the log is recreated when the
+    # manager app is reinstalled or its data cleared.
+    inode = os.stat(path).st_ino
+    if cursor.get("path") != path or cursor.get("inode") != inode:
+        cursor.update({"path": path, "inode": inode, "rowid": 0})
+    events = []
+    for row in query_db(path, "SELECT rowid AS rowid, * FROM logs WHERE rowid > ? ORDER BY rowid",
+                        (cursor["rowid"],)):
+        cursor["rowid"] = row["rowid"]
+        uid = row.get("fromUid")
+        events.append({
+            "event": "su",
+            "id": row["rowid"],
+            "time": datetime.datetime.fromtimestamp(
+                (row.get("time") or 0) / 1000).isoformat(timespec="seconds"),
+            "uid": uid,
+            "package": uid_package(uid, names) or row.get("packageName"),
+            "app": row.get("appName"),
+            "pid": row.get("fromPid"),
+            "to_uid": row.get("toUid"),
+            "command": row.get("command"),
+            "action": "allow" if row.get("action") == 2 else "deny",
+        })
+    return events
+
+
+def su_policy_events(path, cursor, names):
+    # The policies table is small but read only when magisk.db changed.
+    policies = {}
+    for row in query_db(path, "SELECT uid, policy, until FROM policies"):
+        policies[str(row["uid"])] = (
+            "allow" if row["policy"] == 2 else "deny", row["until"])
+    events = []
+    previous = cursor.get("policies")
+    if previous is not None:
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        for uid in sorted(set(previous) | set(policies), key=int):
+            if previous.get(uid) == (list(policies[uid]) if uid in policies else None):
+                continue
+            policy, until = policies.get(uid, ("removed", None))
+            events.append({"event": "policy", "time": now, "uid": int(uid),
+                           "package": uid_package(int(uid), names),
+                           "policy": policy, "until": until})
+    cursor["policies"] = {uid: list(value) for uid, value in policies.items()}
+    return events
+
+
+def su_audit(follow=False, interval=SU_AUDIT_INTERVAL, from_start=False):
+    # Yields "su" events for every logged su request and "policy" events
+    # when an app's su policy changes. The cursor is saved after each poll.
+    magisk_db = container_data("adb", "magisk.db")
+    cursors = read_su_cursors()
+    key = instance().waydroid_dir
+    cursor = {} if from_start else cursors.get(key, {})
+    cursor.setdefault("su", {})
+    cursor.setdefault("magisk", {})
+    versions = {}
+    warned = False
+    while True:
+        names = package_names()
+        events = []
+        sulogs = find_sulogs()
+        if sulogs and versions.get("su") != db_version(sulogs):
+            versions["su"] = db_version(sulogs)
+            events.extend(su_log_events(sulogs, cursor["su"], names))
+        elif not sulogs and not warned:
+            logging.warning("No su log found, su requests are logged by the Kitsune Mask app")
+            warned = True
+        if os.path.isfile(magisk_db) and versions.get("magisk") != db_version(magisk_db):
+            versions["magisk"] = db_version(magisk_db)
+            events.extend(su_policy_events(magisk_db, cursor["magisk"], names))
+        yield from events
+        if events or key not in cursors or from_start:
+            cursors[key] = cursor
+            write_su_cursors(cursors)
+            from_start = False
+        if not follow:
+            return
+        time.sleep(interval)
+
+
+# Apply
+
+STATE_KEYS = ["magisk", "modules", "su", "hidelist", "zygisk"]
+
+
+def read_state(path):
+    try:
+        with open(path, "r") as handle:
+            state = json.load(handle)
+    except (OSError, ValueError) as exc:
+        logging.error("Failed to read %s: %s" % (path, exc))
+        return None
+    # Files named by the state are relative to it.
+    return normalize_state(state, os.path.dirname(os.path.abspath(path)), path)
+
+
+def normalize_state(state, base, name="state"):
+    # Checks a state as documented and returns it in the shape apply_state()
+    # works on: absolute paths, a modules dict and a set of hidelist entries.
+    if not isinstance(state, dict):
+        logging.error("%s is not a JSON object" % name)
+        return None
+    unknown = sorted(set(state) - set(STATE_KEYS))
+    if unknown:
+        logging.error("Unknown keys in %s: %s" % (name, ", ".join(unknown)))
+        return None
+    for key in STATE_KEYS:
+        kind = list if key == "hidelist" else dict
+        if state.get(key) is not None and not isinstance(state[key], kind):
+            logging.error("%s in %s is not a JSON %s" % (
+                key, name, "array" if kind is list else "object"))
+            return None
+    if not all(isinstance(entry, str) for entry in state.get("hidelist") or []):
+        logging.error("hidelist in %s has entries that are not strings" % name)
+        return None
+    for modid, modpath in (state.get("modules") or {}).items():
+        if modpath is not None and not isinstance(modpath, str):
+            logging.error("Invalid module path for %s: %s" % (modid, modpath))
+            return None
+    state = dict(state)
+    magisk = state.get("magisk")
+    if magisk is not None:
+        magisk = state["magisk"] = dict(magisk)
+        for key in ["apk", "bundle"]:
+            if magisk.get(key):
+                magisk[key] = os.path.join(base, magisk[key])
+    state["modules"] = {
+        modid: os.path.join(base, modpath) if modpath else None
+        for modid, modpath in (state.get("modules") or {}).items()}
+    for pkg, policy in (state.get("su") or {}).items():
+        if policy not in ["allow", "deny"]:
+            logging.error("Invalid su policy for %s: %s" % (pkg, policy))
+            return None
+    if state.get("hidelist") is not None:
+        state["hidelist"] = read_hidelist(state["hidelist"])
+        if state["hidelist"] is None:
+            return None
+    return state
+
+
+def plan_magisk(spec):
+    # Returns the install/update keyword arguments, {} when the installed
+    # build already matches and None on error.
+    record = read_install_record() or {}
+    channel = spec.get("channel") or record.get("channel") or "canary"
+    version = spec.get("version")
+    if version == "latest":
+        try:
+            version = cached_json(
+                channel_json_url(channel, spec.get("channel_url")),
+                "Kitsune Mask %s channel" % channel,
+                CHANNEL_CACHE_TTL)["magisk"]["version"]
+        except ValueError as exc:
+            logging.error(exc)
+            return None
+    if record and record.get("channel") == channel and (
+            not version or version == installed_version(record)) and (
+            not spec.get("manager") or record.get("manager")):
+        return {}
+    arch, bits = get_arch()
+    kwargs = {"with_manager": bool(spec.get("manager")),
+              "apk_path": spec.get("apk"), "bundle_path": spec.get("bundle"),
+              "channel_url": spec.get("channel_url")}
+    if version and not kwargs["apk_path"] and not kwargs["bundle_path"]:
+        cached = bundle_file(channel, version, arch, kwargs["with_manager"])
+        if os.path.isfile(cached):
+            kwargs["bundle_path"] = cached
+        elif spec.get("version") != "latest":
+            try:
+                latest = cached_json(
+                    channel_json_url(channel, spec.get("channel_url")),
+                    "Kitsune Mask %s channel" % channel,
+                    CHANNEL_CACHE_TTL)["magisk"]["version"]
+            except ValueError as exc:
+                logging.error(exc)
+                return None
+            if latest != version:
+                logging.error("Kitsune Mask %s is neither bundled nor the latest %s build" %
+                              (version, channel))
+                return None
+    kwargs.update({"arch": arch, "bits": bits, "magisk_channel": channel})
+    return kwargs
+
+
+def read_container_state():
+    # Everything apply compares against is read in one concurrent batch.
+    with WaydroidFreezeUnfreeze():
+        results = gather(
+            magisk_sqlite_async("SELECT uid, policy FROM policies"),
+            magisk_sqlite_async("SELECT value FROM settings WHERE key == 'zygisk'"),
+            magisk_sqlite_async("SELECT value FROM settings WHERE key == 'new_zygisk'"),
+            magisk_cmd_async(["magiskhide", "ls"]))
+    policies_out, zygisk_out, new_zygisk_out, (hide_status, hide_out) = results
+    policies = {}
+    for line in policies_out.splitlines():
+        row = dict(field.split("=", 1) for field in line.split("|") if "=" in field)
+        if "uid" in row and "policy" in row:
+            policies[int(row["uid"])] = int(row["policy"])
+    adb = os.path.join(xdg_data_home(), "waydroid", "data", "adb")
+    modules = set()
+    for name in ["modules", "modules_update"]:
+        if os.path.isdir(os.path.join(adb, name)):
+            modules.update(os.listdir(os.path.join(adb, name)))
+    return {
+        "policies": policies,
+        "zygisk": bool(zygisk_out) and zygisk_out.split("=")[-1].strip() == "1",
+        "new_zygisk": bool(new_zygisk_out) and new_zygisk_out.split("=")[-1].strip() == "1",
+        "hidelist": read_hidelist(hide_out.splitlines()) if hide_status == 0 else None,
+        "modules": modules,
+    }
+
+
+@exclusive
+def apply_state(state, dry_run=False):
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    changes = []
+    # An empty hidelist still has to be applied.
+    container_keys = [key for key in STATE_KEYS[1:] if state.get(key) or (
+        key == "hidelist" and state.get(key) is not None)]
+    if state.get("magisk") is not None:
+        kwargs = plan_magisk(state["magisk"])
+        if kwargs is None:
+            return
+        if kwargs:
+            installed = is_installed()
+            changes.append("magisk: %s %s" % (
+                "update to" if installed else "install",
+                state["magisk"].get("version") or kwargs["magisk_channel"]))
+            print("- %s" % changes[-1])
+            if dry_run:
+                return True
+            if installed:
+                result = update(restart_after=True, **kwargs)
+            else:
+                result = install_transactional(restart_after=True, **kwargs)
+            if result and container_keys:
+                logging.info("Run apply again once Waydroid booted with the new Kitsune Mask to apply the rest")
+            return result
+    if not container_keys:
+        if not changes:
+            logging.info("Nothing to do")
+        return True
+    if not magisk_ready():
+        return
+    restart = False
+    if not is_set_up():
+        changes.append("magisk: setup")
+        print("- %s" % changes[-1])
+        if not dry_run and not setup(restart_after=False):
+            return
+        restart = True
+    current = read_container_state()
+    ok = True
+
+    # Modules, all zips to install are validated before the first one is.
+    # A zip that isn't there is taken from the module store by its id.
+    missing = {}
+    for modid, modpath in sorted(state["modules"].items()):
+        if modpath and modid not in current["modules"]:
+            missing[modid] = resolve_module(modpath) or stored_module(modid)
+            if not missing[modid]:
+                logging.error("%s does not exist and %s is not in the module store" %
+                              (modpath, modid))
+                return
+    checked = {}
+    if missing:
+        results, errors = preflight_modules(list(missing.values()))
+        checked = dict(zip(missing, results))
+        for error in errors:
+            logging.error(error)
+        if errors:
+            return
+    for modid, modpath in sorted(state["modules"].items()):
+        if modpath and modid not in current["modules"]:
+            changes.append("module: install %s" % modid)
+            print("- %s" % changes[-1])
+            if not dry_run:
+                if not install_module(missing[modid], restart_after=False):
+                    return
+                store_module(missing[modid], checked[modid])
+            restart = True
+        elif not modpath and modid in current["modules"]:
+            changes.append("module: remove %s" % modid)
+            print("- %s" % changes[-1])
+            if not dry_run:
+                adb = os.path.join(xdg_data_home(), "waydroid", "data", "adb")
+                for name in ["modules", "modules_update"]:
+                    remove_path(os.path.join(adb, name, modid))
+            restart = True
+
+    # Su policies, applied in a single sqlite call
+    statements = []
+    if state.get("su"):
+        uids = package_uids()
+        for pkg, policy in sorted(state["su"].items()):
+            if pkg not in uids:
+                logging.error("%s is not installed" % pkg)
+                ok = False
+                continue
+            value = 2 if policy == "allow" else 1
+            if current["policies"].get(uids[pkg]) != value:
+                changes.append("su: %s %s" % (policy, pkg))
+                print("- %s" % changes[-1])
+                statements.append("REPLACE INTO policies VALUES(%s,%s,0,1,1)" %
+                                  (uids[pkg], value))
+    if statements and not dry_run:
+        magisk_sqlite("; ".join(statements))
+
+    # Hidelist
+    if state.get("hidelist") is not None:
+        if current["hidelist"] is None:
+            logging.error("Failed to read the hidelist")
+            ok = False
+        else:
+            adds, removes = diff_hidelist(current["hidelist"], state["hidelist"])
+            for prefix, entries in [("rm", removes), ("add", adds)]:
+                for entry in entries:
+                    changes.append("magiskhide: %s %s" % (prefix, format_hide_entry(entry)))
+                    if dry_run:
+                        print("- %s" % changes[-1])
+            if (adds or removes) and not dry_run:
+                ok = apply_hidelist(state["hidelist"], current["hidelist"]) and ok
+
+    # Zygisk
+    statements = []
+    for key in ["zygisk", "new_zygisk"]:
+        wanted = (state.get("zygisk") or {}).get(key)
+        if wanted is not None and bool(wanted) != current[key]:
+            changes.append("zygisk: %s %s" % (key, "enable" if wanted else "disable"))
+            print("- %s" % changes[-1])
+            statements.append("REPLACE INTO settings (key,value) VALUES('%s',%d)" %
+                              (key, 1 if wanted else 0))
+    if statements:
+        if not dry_run:
+            magisk_sqlite("; ".join(statements))
+        restart = True
+
+    if not changes:
+        logging.info("Nothing to do")
+    elif restart and not dry_run:
+        restart_session_if_needed()
+    return ok
+
+
+# Mirror
+
+MIRROR_PORT = 8080
+
+
+def fetch_file(url, dest):
+    import urllib.error
+    import urllib.request
+    digest = hashlib.sha256()
+    tmp = "%s.%s.tmp" % (dest, os.getpid())
+    try:
+        with urllib.request.urlopen(url) as response, open(tmp, "wb") as handle:
+            for chunk in iter(lambda: response.read(1024 * 1024), b""):
+                digest.update(chunk)
+                handle.write(chunk)
+    except urllib.error.HTTPError as exc:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        raise ValueError("Failed to download %s: %s" % (url, exc.code))
+    os.replace(tmp, dest)
+    return digest.hexdigest()
+
+
+def write_json(path, data):
+    tmp = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp, "w") as handle:
+        json.dump(data, handle, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def mirror_sync(directory, channel_url=None):
+    # Channel files are rewritten to link the mirrored files relatively and
+    # carry their sha256, index.json lists every file of the mirror. Files
+    # whose source and versionCode didn't change are not downloaded again.
+    import urllib.parse
+    os.makedirs(directory, exist_ok=True)
+    index_path = os.path.join(directory, "index.json")
+    try:
+        with open(index_path, "r") as handle:
+            old_index = json.load(handle)
+    except (OSError, ValueError):
+        old_index = {}
+    old_files = old_index.get("files", {})
+    index = {"format": 1,
+             "synced": datetime.datetime.now().isoformat(timespec="seconds"),
+             "channels": {}, "files": {}}
+    channels = {}
+    for channel in MAGISK_CHANNELS:
+        json_url = channel_json_url(channel, channel_url)
+        logging.info("Syncing %s channel from %s" % (channel, json_url))
+        metadata = resolve_links(
+            download_json(json_url, "Kitsune Mask %s channel" % channel), json_url)
+        for name, section in metadata.items():
+            if not isinstance(section, dict):
+                continue
+            for key in ["link", "note"]:
+                source = section.get(key)
+                if not source:
+                    continue
+                filename = "%s-%s-%s" % (channel, name, os.path.basename(
+                    urllib.parse.urlparse(source).path))
+                dest = os.path.join(directory, filename)
+                old = old_files.get(filename, {})
+                if old.get("source") == source and \
+                        old.get("versionCode") == section.get("versionCode") and \
+                        os.path.isfile(dest) and sha256sum(dest) == old.get("sha256"):
+                    digest = old["sha256"]
+                else:
+                    logging.info("Downloading %s" % source)
+                    digest = fetch_file(source, dest)
+                index["files"][filename] = {
+                    "sha256": digest, "size": os.path.getsize(dest),
+                    "source": source, "versionCode": section.get("versionCode")}
+                section[key] = filename
+                if key == "link":
+                    section["sha256"] = digest
+        channels[channel] = metadata
+        index["channels"][channel] = metadata.get("magisk", {}).get("version")
+    # The channel files go in once every file they link is in place.
+    for channel, metadata in channels.items():
+        write_json(os.path.join(directory, "%s.json" % channel), metadata)
+    write_json(index_path, index)
+    for filename in set(old_files) - set(index["files"]):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(directory, filename))
+    for channel in MAGISK_CHANNELS:
+        logging.info("%s: %s" % (channel, index["channels"][channel]))
+    return index
+
+
+def mirror_serve(directory, bind="", port=MIRROR_PORT):
+    import http.server
+    if not os.path.isfile(os.path.join(directory, "index.json")):
+        logging.error("%s is not a mirror, run waydroid_magisk mirror sync first" % directory)
+        return
+    handler = functools.partial(
+        http.server.SimpleHTTPRequestHandler, directory=directory)
+    with http.server.ThreadingHTTPServer((bind, port), handler) as server:
+        logging.info("Serving %s on port %s" % (directory, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return True
+
+
 # OTA
 
-def ota():
-    # TODO: Clean this mess I wrote a few days ago when I feel like. And maybe
-    # try to find a better way to manage this.
+OTA_METRICS_INTERVAL = 15
+OTA_COMPARE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class OtaMetrics:
+    def __init__(self, path=None) -> None:
+        self.path = path
+        self.sync_passes = 0
+        self.files_copied = 0
+        self.files_removed = 0
+        self.bytes_copied = 0
+        self.errors = 0
+        self.last_success = 0
+        self.compare_buckets = [0] * len(OTA_COMPARE_BUCKETS)
+        self.compare_count = 0
+        self.compare_sum = 0.0
+        self._dirty = True
+        self._written = 0
+
+    def observe_compare(self, seconds):
+        self.compare_count += 1
+        self.compare_sum += seconds
+        for i, bound in enumerate(OTA_COMPARE_BUCKETS):
+            if seconds <= bound:
+                self.compare_buckets[i] += 1
+
+    def copied(self, nbytes, files=1):
+        self.files_copied += files
+        self.bytes_copied += nbytes
+        self._dirty = True
+
+    def removed(self):
+        self.files_removed += 1
+        self._dirty = True
+
+    def failed(self):
+        self.errors += 1
+        self._dirty = True
+
+    def passed(self):
+        self.sync_passes += 1
+        self.last_success = time.time()
+
+    def render(self):
+        lines = []
+
+        def metric(name, kind, helptext, samples):
+            lines.append("# HELP waydroid_magisk_ota_%s %s" % (name, helptext))
+            lines.append("# TYPE waydroid_magisk_ota_%s %s" % (name, kind))
+            for suffix, value in samples:
+                lines.append("waydroid_magisk_ota_%s%s %s" % (name, suffix, value))
+
+        metric("sync_passes_total", "counter", "Completed OTA sync passes.",
+               [("", self.sync_passes)])
+        metric("files_copied_total", "counter",
+               "Magisk files copied into the overlay.",
+               [("", self.files_copied)])
+        metric("files_removed_total", "counter",
+               "Magisk files removed from the overlay.",
+               [("", self.files_removed)])
+        metric("bytes_copied_total", "counter",
+               "Bytes copied into the overlay.", [("", self.bytes_copied)])
+        metric("errors_total", "counter", "Failed OTA sync passes.",
+               [("", self.errors)])
+        metric("last_success_timestamp_seconds", "gauge",
+               "Unix time of the last successful sync pass.",
+               [("", "%.3f" % self.last_success)])
+        samples = [('_bucket{le="%s"}' % bound, count)
+                   for bound, count in zip(OTA_COMPARE_BUCKETS, self.compare_buckets)]
+        samples.append(('_bucket{le="+Inf"}', self.compare_count))
+        samples.append(("_sum", "%.6f" % self.compare_sum))
+        samples.append(("_count", self.compare_count))
+        metric("compare_seconds", "histogram",
+               "Time spent comparing rw and ro Magisk files.", samples)
+        return "\n".join(lines) + "\n"
+
+    def write(self, force=False):
+        if not self.path:
+            return
+        now = time.time()
+        if not force and not self._dirty and now - self._written < OTA_METRICS_INTERVAL:
+            return
+        # Write to a temporary file first so the textfile collector never
+        # reads a partially written file.
+        tmp = "%s.%s.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as handle:
+            handle.write(self.render())
+        os.replace(tmp, self.path)
+        self._dirty = False
+        self._written = now
+
+
+FICLONE = 0x40049409
+
+
+def file_digest(path, digests):
+    # Keyed by inode, size and mtime so unchanged files are only hashed once
+    stat = os.stat(path)
+    key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = digests.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    digest = sha256sum(path)
+    digests[path] = (key, digest)
+    return digest
+
+
+def clone_file(source, dest):
+    # Reflink when the filesystem supports it, then copy_file_range so the
+    # data stays in the kernel, then a plain copy.
+    import fcntl
+    with open(source, "rb") as src, open(dest, "wb") as dst:
+        with contextlib.suppress(OSError):
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        size = os.fstat(src.fileno()).st_size
+        if hasattr(os, "copy_file_range"):
+            copied = 0
+            with contextlib.suppress(OSError):
+                while copied < size:
+                    count = os.copy_file_range(
+                        src.fileno(), dst.fileno(), size - copied)
+                    if not count:
+                        break
+                    copied += count
+            if copied >= size:
+                return
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+
+
+def same_file(source, dest, digests):
+    if not os.path.isfile(dest) or os.path.islink(dest):
+        return False
+    if os.stat(source).st_size != os.stat(dest).st_size:
+        return False
+    return file_digest(source, digests) == file_digest(dest, digests)
+
+
+def sync_file(source, dest, digests):
+    # Returns the number of bytes written, the destination is replaced
+    # atomically so it's never seen missing or half written.
+    if same_file(source, dest, digests):
+        mode = os.stat(source).st_mode & 0o7777
+        if os.stat(dest).st_mode & 0o7777 != mode:
+            os.chmod(dest, mode)
+        return 0
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        shutil.rmtree(dest)
+    tmp = os.path.join(os.path.dirname(dest), ".%s.%s.tmp" %
+                       (os.path.basename(dest), os.getpid()))
+    try:
+        clone_file(source, tmp)
+        shutil.copymode(source, tmp)
+        os.replace(tmp, dest)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+    return os.path.getsize(dest)
+
+
+def sync_tree(source, dest, digests):
+    # Returns (files, bytes) written, only changed files are rewritten and
+    # files that are gone from the source are removed.
+    files = written = 0
+    if os.path.exists(dest) and not os.path.isdir(dest):
+        os.remove(dest)
+    for root, dirs, names in os.walk(source):
+        target = os.path.join(dest, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            count = sync_file(os.path.join(root, name),
+                              os.path.join(target, name), digests)
+            if count:
+                files += 1
+                written += count
+        for name in os.listdir(target):
+            if name in dirs or name in names:
+                continue
+            path = os.path.join(target, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+    return files, written
+
+
+def ota(metrics_file=None):
+    inst = instance()
+    metrics = OtaMetrics(metrics_file)
+    digests = {}
+
     def copy(source):
-        logging.info("Copying Magisk File: %s" % os.path.basename(source))
         dest = source.replace("overlay_rw/system/", "overlay/")
         if os.path.isdir(source):
-            if os.path.exists(dest):
-                shutil.rmtree(dest)
-            os.makedirs(dest)
-            shutil.copytree(source, dest)
+            files, written = sync_tree(source, dest, digests)
         else:
-            if os.path.exists(dest):
-                os.remove(dest)
-            shutil.copy(source, dest)
+            written = sync_file(source, dest, digests)
+            files = 1 if written else 0
+        if files:
+            logging.info("Copied Magisk File: %s" % os.path.basename(source))
+            metrics.copied(written, files)
 
     def remove(source):
         logging.info("Removing Kitsune Mask File '%s'" %
@@ -867,41 +3087,924 @@ def ota():
             else:
                 os.remove(dest)
         os.remove(source)
-        if os.path.isdir(os.path.join(OVERLAY, "sbin")):
-            shutil.rmtree(os.path.join(OVERLAY, "sbin"))
-
-    if not has_overlay():
-        raise ValueError("OTA survival not supported on non overlay Waydroid")
-    while True:
-        if os.path.exists(MAGISK_OVERLAY):
-            if os.path.isfile(MAGISK_OVERLAY):
-                for mfile in MAGISK_FILES:
+        metrics.removed()
+        if os.path.isdir(os.path.join(inst.overlay, "sbin")):
+            shutil.rmtree(os.path.join(inst.overlay, "sbin"))
+
+    def sync():
+        if os.path.exists(inst.magisk_overlay):
+            if os.path.isfile(inst.magisk_overlay):
+                for mfile in inst.magisk_files:
                     if os.path.exists(mfile):
                         remove(mfile)
-                remove(MAGISK_OVERLAY)
+                remove(inst.magisk_overlay)
             else:
-                for mfile in MAGISK_FILES:
+                changed = []
+                started = time.monotonic()
+                for mfile in inst.magisk_files:
+                    if not os.path.exists(mfile):
+                        continue
                     overlay = mfile.replace("overlay_rw/system/", "overlay/")
                     if (
-                        os.path.exists(mfile)
-                        and os.path.exists(overlay)
-                        and not filecmp.cmp(mfile, overlay)
+                        os.path.isdir(mfile)
+                        or not same_file(mfile, overlay, digests)
+                        or os.stat(mfile).st_mode != os.stat(overlay).st_mode
                     ):
-                        copy(mfile)
-                    if os.path.exists(mfile) and not os.path.exists(overlay):
-                        copy(mfile)
+                        changed.append(mfile)
+                metrics.observe_compare(time.monotonic() - started)
+                for mfile in changed:
+                    copy(mfile)
+
+    if not has_overlay():
+        raise ValueError("OTA survival not supported on non overlay Waydroid")
+    while True:
+        try:
+            # A pass is skipped while a command rewrites the Magisk files.
+            with InstanceLock(blocking=False):
+                sync()
+        except BlockingIOError:
+            pass
+        except OSError as exc:
+            logging.error("OTA sync failed: %s" % exc)
+            metrics.failed()
+        else:
+            metrics.passed()
+        try:
+            metrics.write()
+        except OSError as exc:
+            logging.error("Failed to write OTA metrics: %s" % exc)
         time.sleep(1)
 
 
-def main():
+# Daemon
+
+IN_DAEMON = False
+
+
+class ContainerShell:
+    def __init__(self, lxc) -> None:
+        self._lxc = lxc
+        self._proc = None
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        self._proc = subprocess.Popen(
+            ["lxc-attach", "-P", self._lxc, "-n", "waydroid", "--", "su"],
+            env={"PATH": os.environ['PATH'] + ":/system/bin:/vendor/bin"},
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self._run("mknod -m 666 /dev/tty c 5 0 2> /dev/null")
+
+    def _run(self, cmdline):
+        marker = "__waydroid_magisk_%s__" % "".join(
+            random.choice(string.ascii_letters) for _ in range(12))
+        self._proc.stdin.write(
+            ("( %s ) < /dev/null 2> /dev/null; printf '\\n%s\\n'\n" %
+             (cmdline, marker)).encode())
+        self._proc.stdin.flush()
+        lines = []
+        while True:
+            line = self._proc.stdout.readline()
+            if not line:
+                self.close()
+                raise OSError("container shell exited")
+            line = line.decode()
+            if line.rstrip("\n") == marker:
+                break
+            lines.append(line)
+        result = "".join(lines)
+        return result[:-1] if result.endswith("\n") else result
+
+    def run(self, cmdline):
+        with self._lock:
+            if not self._proc or self._proc.poll() is not None:
+                self._spawn()
+            return self._run(cmdline)
+
+    def close(self):
+        if self._proc and self._proc.poll() is None:
+            with contextlib.suppress(OSError):
+                self._proc.stdin.close()
+            self._proc.terminate()
+        self._proc = None
+
+
+# Output of a command ran by the daemon or a fleet worker is captured per
+# thread, log lines of other threads (the OTA loop) keep going to the journal.
+_capture = threading.local()
+_capture_lock = threading.Lock()
+
+
+class _CaptureStream(io.TextIOBase):
+    def __init__(self, name, fallback) -> None:
+        self._name = name
+        self._fallback = fallback
+
+    def _target(self):
+        stream = getattr(_capture, self._name, None)
+        return self._fallback if stream is None else stream
+
+    def write(self, data):
+        return self._target().write(data)
+
+    def flush(self):
+        self._target().flush()
+
+
+class _CaptureHandler(logging.Handler):
+    def emit(self, record):
+        stream = getattr(_capture, "stderr", None)
+        if stream is not None:
+            stream.write(self.format(record) + "\n")
+
+
+def _not_captured(record):
+    return getattr(_capture, "stderr", None) is None
+
+
+@contextlib.contextmanager
+def capture_output(stdout=None, stderr=None):
+    with _capture_lock:
+        if not isinstance(sys.stdout, _CaptureStream):
+            root = logging.getLogger()
+            handler = _CaptureHandler()
+            if root.handlers:
+                handler.setFormatter(root.handlers[0].formatter)
+            for existing in root.handlers:
+                existing.addFilter(_not_captured)
+            root.addHandler(handler)
+            sys.stdout = _CaptureStream("stdout", sys.stdout)
+            sys.stderr = _CaptureStream("stderr", sys.stderr)
+    _capture.stdout = stdout or io.StringIO()
+    _capture.stderr = stderr or io.StringIO()
+    try:
+        yield _capture.stdout, _capture.stderr
+    finally:
+        _capture.stdout = None
+        _capture.stderr = None
+
+
+def run_captured(argv, root=None):
+    with capture_output() as (stdout, stderr):
+        try:
+            status = main(argv, forward=False, root=root) or 0
+        except SystemExit as exc:
+            status = exc.code if isinstance(exc.code, int) else 1
+        except Exception as exc:
+            logging.exception("Request failed: %s" % exc)
+            status = 1
+        return {"status": status, "stdout": stdout.getvalue(),
+                "stderr": stderr.getvalue()}
+
+
+# A request is one JSON line. While a command runs its output is streamed
+# back as "output" notifications and anything the client sends cancels it,
+# like ^C would, before the final response.
+DAEMON_TIMEOUT = 10
+# Environment of the client the commands depend on.
+DAEMON_ENV = ["WAYDROID_MAGISK_CHANNEL_URL"]
+
+
+def send_message(conn, message):
+    conn.sendall(json.dumps(message).encode() + b"\n")
+
+
+def read_message(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data.decode())
+
+
+class _DaemonStream(io.TextIOBase):
+    def __init__(self, conn, name) -> None:
+        self._conn = conn
+        self._name = name
+        self.broken = False
+
+    def write(self, data):
+        # A client that stopped reading doesn't stop the command.
+        if data and not self.broken:
+            try:
+                send_message(self._conn, {"jsonrpc": "2.0", "method": "output", "params": {
+                    "stream": self._name, "data": data}})
+            except OSError:
+                self.broken = True
+        return len(data)
+
+
+@contextlib.contextmanager
+def client_context(params):
+    # Commands run in the cwd and with the environment of the client, so
+    # relative paths and settings mean the same as without the daemon.
+    cwd = os.getcwd()
+    saved = {name: os.environ.get(name) for name in DAEMON_ENV}
+    try:
+        os.chdir(params.get("cwd") or "/")
+        for name in DAEMON_ENV:
+            value = (params.get("env") or {}).get(name)
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        yield
+    finally:
+        os.chdir(cwd)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run_for_client(conn, params):
+    import _thread
+    state = {"running": True, "cancelled": False}
+    lock = threading.Lock()
+
+    def watch():
+        # Any data from the client is a cancel, like a closed connection.
+        while True:
+            try:
+                conn.recv(4096)
+            except socket.timeout:
+                with lock:
+                    if not state["running"]:
+                        return
+                continue
+            except OSError:
+                pass
+            break
+        with lock:
+            if state["running"]:
+                state["cancelled"] = True
+                _thread.interrupt_main()
+
+    threading.Thread(target=watch, daemon=True).start()
+    stdout = _DaemonStream(conn, "stdout")
+    stderr = _DaemonStream(conn, "stderr")
+    argv = [str(arg) for arg in params.get("argv", [])]
+    try:
+        with capture_output(stdout, stderr), client_context(params):
+            try:
+                status = main(argv, forward=False) or 0
+            except SystemExit as exc:
+                status = exc.code if isinstance(exc.code, int) else 1
+            except KeyboardInterrupt:
+                logging.info("Canceled")
+                status = 130
+            except Exception as exc:
+                logging.exception("Request failed: %s" % exc)
+                status = 1
+            finally:
+                with lock:
+                    state["running"] = False
+    except KeyboardInterrupt:
+        # The cancel arrived as the command finished.
+        if not state["cancelled"]:
+            raise
+        status = 130
+    return {"status": status}
+
+
+def handle_daemon_request(conn, request):
+    response = {"jsonrpc": "2.0", "id": request.get("id")}
+    method = request.get("method")
+    if method == "ping":
+        response["result"] = {"version": VERSION}
+    elif method == "run":
+        response["result"] = run_for_client(conn, request.get("params", {}))
+    else:
+        response["error"] = {"code": -32601, "message": "Method not found"}
+    return response
+
+
+def daemon(with_ota=False, metrics_file=None):
+    global IN_DAEMON
+    if not is_root():
+        logging.error("This command needs to be ran as a priviliged user!")
+        return
+    IN_DAEMON = True
+    shell = ContainerShell(instance().lxc)
+    _container_shells[instance().waydroid_dir] = shell
+    if with_ota:
+        # Threads don't inherit the instance set by --root.
+        threading.Thread(target=contextvars.copy_context().run, args=(ota,),
+                         kwargs={"metrics_file": metrics_file}, daemon=True).start()
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(DAEMON_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(DAEMON_SOCKET)
+    finally:
+        os.umask(old_umask)
+    os.chmod(DAEMON_SOCKET, 0o600)
+    server.listen(8)
+    logging.info("Listening on %s" % DAEMON_SOCKET)
+    try:
+        # Requests are served one at a time, the module level state
+        # (session, caches, container shell, cwd) isn't shared between
+        # threads. The timeout keeps a stalled client from blocking the
+        # others.
+        while True:
+            conn, _addr = server.accept()
+            with conn:
+                conn.settimeout(DAEMON_TIMEOUT)
+                creds = conn.getsockopt(
+                    socket.SOL_SOCKET, socket.SO_PEERCRED, 12)
+                if int.from_bytes(creds[4:8], sys.byteorder) != 0:
+                    continue
+                try:
+                    request = read_message(conn)
+                except OSError:
+                    continue
+                except ValueError:
+                    response = {"jsonrpc": "2.0", "id": None, "error": {
+                        "code": -32700, "message": "Parse error"}}
+                else:
+                    response = handle_daemon_request(conn, request)
+                with contextlib.suppress(OSError):
+                    send_message(conn, response)
+    finally:
+        server.close()
+        _container_shells.pop(instance().waydroid_dir, None)
+        shell.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(DAEMON_SOCKET)
+
+
+def call_daemon(argv):
+    if os.environ.get("WAYDROID_MAGISK_NO_DAEMON") or not os.path.exists(DAEMON_SOCKET):
+        return None
+    request = {"jsonrpc": "2.0", "id": 1, "method": "run", "params": {
+        "argv": argv, "cwd": os.getcwd(),
+        "env": {name: os.environ.get(name) for name in DAEMON_ENV}}}
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(DAEMON_SOCKET)
+        send_message(conn, request)
+    except OSError:
+        conn.close()
+        return None
+    with conn, conn.makefile("rb") as stream:
+        answered = False
+        cancelled = False
+        while True:
+            try:
+                message = json.loads(stream.readline().decode())
+            except KeyboardInterrupt:
+                # The first ^C cancels the command in the daemon, the
+                # second one gives up on it.
+                if cancelled:
+                    return 130
+                cancelled = True
+                with contextlib.suppress(OSError):
+                    conn.sendall(b"cancel\n")
+                continue
+            except (OSError, ValueError):
+                # Ran locally if the daemon didn't take the request.
+                if not answered:
+                    return None
+                logging.error("Lost the connection to the daemon")
+                return 1
+            answered = True
+            if message.get("method") == "output":
+                target = sys.stdout if message["params"]["stream"] == "stdout" else sys.stderr
+                target.write(message["params"]["data"])
+                target.flush()
+            elif "result" in message:
+                return message["result"]["status"]
+            else:
+                return None
+
+
+def is_daemon_command(args):
+    if IN_DAEMON or args.ota or args.command == "daemon":
+        return False
+    if args.command == "su" and args.command_su in ["shell", "audit"]:
+        return False
+    if args.command == "log" and not args.save:
+        return False
+    # stdin isn't forwarded.
+    if args.command == "magiskhide" and args.command_magiskhide == "apply" and \
+            args.FILE == "-":
+        return False
+    # Doesn't touch Waydroid, and serve runs until it's stopped.
+    if args.command == "mirror":
+        return False
+    return True
+
+
+# Fleet
+
+FLEET_COMMANDS = ["install", "update", "status", "verify", "module"]
+
+
+def read_instances(path):
+    roots = []
+    with open(path, "r") as handle:
+        for line in handle:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                roots.append(line)
+    return roots
+
+
+def run_fleet(argv, roots, jobs, output="text"):
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(
+            lambda root: run_captured(argv, root=root), roots))
+    status = 0
+    documents = []
+    for root, result in zip(roots, results):
+        if result["status"]:
+            status = 1
+        if output != "text":
+            # Each worker printed one JSON document (or NDJSON lines).
+            lines = result["stdout"].splitlines()
+            try:
+                if output == "ndjson":
+                    document = [json.loads(line) for line in lines if line.strip()]
+                else:
+                    document = json.loads(result["stdout"]) if lines else None
+            except ValueError:
+                document = None
+            documents.append({"root": root, "status": result["status"],
+                              "result": document, "stderr": result["stderr"]})
+            continue
+        print("==> %s <==" % root)
+        sys.stdout.write(result["stdout"])
+        sys.stdout.write(result["stderr"])
+    if output != "text":
+        emit(output, documents)
+        return status
+    failed = sum(1 for result in results if result["status"])
+    logging.info("%s of %s instances succeeded" % (len(roots) - failed, len(roots)))
+    return status
+
+
+# API
+
+class MagiskError(Exception):
+    pass
+
+
+class NotRootError(MagiskError):
+    pass
+
+
+class NotRunningError(MagiskError):
+    pass
+
+
+class NotInstalledError(MagiskError):
+    pass
+
+
+class IncompleteSetupError(MagiskError):
+    pass
+
+
+@contextlib.contextmanager
+def using_instance(inst):
+    token = _instance.set(inst)
+    try:
+        yield inst
+    finally:
+        _instance.reset(token)
+
+
+class _ErrorCollector(logging.Handler):
+    # Error messages logged by the current thread.
+    def __init__(self) -> None:
+        super().__init__(logging.ERROR)
+        self._thread = threading.get_ident()
+        self.messages = []
+
+    def emit(self, record):
+        if record.thread == self._thread:
+            self.messages.append(record.getMessage())
+
+
+def parse_sqlite_rows(result):
+    rows = []
+    for line in (result or "").splitlines():
+        rows.append(dict(
+            field.split("=", 1) for field in line.split("|") if "=" in field))
+    return rows
+
+
+class Manager:
+    # In-process API: queries return data and failures raise MagiskError.
+    # The installed/setup checks are cached like the package list and
+    # dropped by every mutation, queries go through a persistent su shell.
+
+    def __init__(self, waydroid_dir=WAYDROID_DIR, persistent_shell=True) -> None:
+        self.instance = WaydroidInstance(waydroid_dir)
+        self._checks = {}
+        self._shell = None
+        if persistent_shell and self.instance.waydroid_dir not in _container_shells:
+            self._shell = ContainerShell(self.instance.lxc)
+            _container_shells[self.instance.waydroid_dir] = self._shell
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._shell:
+            if _container_shells.get(self.instance.waydroid_dir) is self._shell:
+                del _container_shells[self.instance.waydroid_dir]
+            self._shell.close()
+            self._shell = None
+
+    @contextlib.contextmanager
+    def _using(self):
+        # Download, channel and file errors of the functions below surface
+        # as MagiskError like everything else.
+        with using_instance(self.instance):
+            try:
+                yield
+            except (OSError, ValueError) as exc:
+                raise MagiskError(str(exc)) from exc
+
+    def _call(self, error, func, *args, **kwargs):
+        # The functions log why they failed and return None, the first error
+        # they logged is the cause.
+        errors = _ErrorCollector()
+        logging.getLogger().addHandler(errors)
+        try:
+            with self._using():
+                result = func(*args, **kwargs)
+        except MagiskError as exc:
+            raise MagiskError("%s: %s" % (error, exc)) from exc.__cause__
+        finally:
+            logging.getLogger().removeHandler(errors)
+        if not result:
+            raise MagiskError("%s: %s" % (error, errors.messages[0]) if errors.messages else error)
+        return result
+
+    def _cached(self, name, func):
+        checked = self._checks.get(name)
+        if checked and time.monotonic() - checked[0] < PACKAGE_CACHE_TTL:
+            return checked[1]
+        value = func()
+        self._checks[name] = (time.monotonic(), value)
+        return value
+
+    def _changed(self):
+        self._checks.clear()
+        _package_cache.pop(self.instance.waydroid_dir, None)
+
+    def check(self, running=True, installed=True, setup=False):
+        with self._using():
+            if not is_root():
+                raise NotRootError("This command needs to be ran as a priviliged user!")
+            if running and not is_running():
+                raise NotRunningError("Waydroid session is not running")
+            if installed and not self._cached("installed", is_installed):
+                raise NotInstalledError("Kitsune Mask is not installed")
+            if setup and is_running() and not self._cached("setup", is_set_up):
+                raise IncompleteSetupError("Incomplete magisk setup")
+
+    # Queries
+
+    def install_record(self):
+        with self._using(), InstanceLock():
+            return read_install_record()
+
+    def generations(self):
+        with self._using(), InstanceLock():
+            return [{key: value for key, value in generation.items() if key != "path"}
+                    for generation in list_generations()]
+
+    # Every query is a container call and a parser, report() gathers all
+    # of them in one batch.
+
+    def status(self):
+        self.check()
+        with self._using(), InstanceLock():
+            return self._parse_status(*su_many(
+                ["pidof", "magiskd"], ["magisk", "su", "--version"]))
+
+    def _parse_status(self, pidof, version):
+        error = None
+        if not pidof.strip() and os.path.isfile("/var/log/syslog"):
+            with open("/var/log/syslog", "r") as dmesg:
+                message = "Abort message: 'stack corruption detected (-fstack-protector)'"
+                if dmesg.read().find(message) > -1:
+                    error = message
+        return {"daemon": bool(pidof.strip()),
+                "pids": [int(pid) for pid in pidof.split() if pid.isdigit()],
+                "version": version.strip() or None,
+                "error": error}
+
+    def modules(self):
+        self.check()
+        with self._using(), InstanceLock():
+            return self._modules(os.path.join(xdg_data_home(), "waydroid", "data", "adb"))
+
+    def _modules(self, adb):
+        modpath = os.path.join(adb, "modules")
+        if not os.path.isdir(modpath):
+            return []
+        modules = []
+        for modid in sorted(os.listdir(modpath)):
+            path = os.path.join(modpath, modid)
+            if not os.path.isdir(path):
+                continue
+            try:
+                props = read_module_prop(os.path.join(path, "module.prop"))
+            except OSError:
+                props = {}
+            modules.append({
+                "id": modid,
+                "name": props.get("name", modid),
+                "version": props.get("version"),
+                "versionCode": props.get("versionCode"),
+                "author": props.get("author"),
+                "description": props.get("description"),
+                "enabled": not os.path.exists(os.path.join(path, "disable")),
+                "remove": os.path.exists(os.path.join(path, "remove")),
+                "update": os.path.isdir(os.path.join(adb, "modules_update", modid)),
+            })
+        return modules
+
+    def policies(self):
+        self.check(setup=True)
+        with self._using(), InstanceLock(), WaydroidFreezeUnfreeze():
+            return self._parse_policies(
+                magisk_sqlite("SELECT * FROM policies"), self._packages())
+
+    def _packages(self):
+        packages = {}
+        with self._using():
+            for name, uid in sorted(package_uids().items()):
+                packages.setdefault(uid, name)
+        return packages
+
+    def _parse_policies(self, result, packages):
+        policies = []
+        for row in parse_sqlite_rows(result):
+            uid = int(row.get("uid", -1))
+            policies.append({
+                "package": packages.get(uid),
+                "uid": uid,
+                "policy": "allow" if int(row.get("policy", 0)) == 2 else "deny",
+                "until": int(row.get("until", 0)),
+                "logging": row.get("logging") == "1",
+                "notification": row.get("notification") == "1",
+            })
+        return policies
+
+    def zygisk(self):
+        self.check(setup=True)
+        with self._using(), InstanceLock():
+            return self._parse_zygisk(*magisk_sqlite_many(
+                "SELECT value FROM settings WHERE key == 'zygisk'",
+                "SELECT value FROM settings WHERE key == 'new_zygisk'"))
+
+    def _parse_zygisk(self, *results):
+        enabled, new_zygisk = [
+            bool(result) and result.split("=")[-1].strip() == "1"
+            for result in results]
+        return {"enabled": enabled, "new_zygisk": new_zygisk}
+
+    def magiskhide(self, *args):
+        self.check(setup=True)
+        query = not args or args[0] in ["status", "sulist", "ls"]
+        with self._using(), InstanceLock(exclusive=not query):
+            status, message = magisk_cmd(["magiskhide"] + list(args))
+        if status == 1:
+            raise MagiskError(message.strip())
+        return message
+
+    def hidelist(self):
+        return self._parse_hidelist(self.magiskhide("ls"))
+
+    def _parse_hidelist(self, message):
+        entries = read_hidelist(message.splitlines())
+        if entries is None:
+            raise MagiskError("Failed to parse the hidelist")
+        return [{"package": pkg, "process": proc}
+                for pkg, proc in sorted(entries, key=format_hide_entry)]
+
+    def report(self):
+        self.check()
+        with self._using(), InstanceLock(), WaydroidFreezeUnfreeze():
+            setup = not is_running() or self._cached("setup", is_set_up)
+            queries = [su_async(["pidof", "magiskd"]),
+                       su_async(["magisk", "su", "--version"])]
+            if setup:
+                packages = self._packages()
+                queries.extend([
+                    magisk_sqlite_async("SELECT * FROM policies"),
+                    magisk_sqlite_async("SELECT value FROM settings WHERE key == 'zygisk'"),
+                    magisk_sqlite_async("SELECT value FROM settings WHERE key == 'new_zygisk'"),
+                    magisk_cmd_async(["magiskhide", "ls"])])
+            if not container_shell():
+                make_tty()
+            results = gather(*queries)
+        report = {
+            "root": self.instance.waydroid_dir,
+            "install": {key: value for key, value in (self.install_record() or {}).items()
+                        if key != "files"} or None,
+            "setup": setup,
+            "status": self._parse_status(*results[:2]),
+            "modules": self.modules(),
+        }
+        if setup:
+            report["policies"] = self._parse_policies(results[2], packages)
+            report["zygisk"] = self._parse_zygisk(*results[3:5])
+            hide_status, message = results[5]
+            report["hidelist"] = (
+                self._parse_hidelist(message) if hide_status == 0 else None)
+        return report
+
+    def verify(self):
+        self.check(running=False, installed=False)
+        with self._using():
+            return bool(verify())
+
+    def update_status(self, refresh=False, channel_url=None):
+        with self._using(), InstanceLock():
+            return self._call("Failed to check for updates", update_status,
+                              refresh, channel_url)
+
+    # Mutations
+
+    def _mutate(self, error, func, *args, **kwargs):
+        try:
+            return self._call(error, func, *args, **kwargs)
+        finally:
+            self._changed()
+
+    def install(self, channel="canary", manager=False, apk=None, bundle=None,
+                workdir=None, restart=True, channel_url=None):
+        self.check(running=False, installed=False)
+        with self._using():
+            if is_installed():
+                raise MagiskError("Kitsune Mask already installed!")
+        arch, bits = get_arch()
+        self._mutate("Installation failed", install_transactional,
+                     arch, bits, channel, restart_after=restart, workdir=workdir,
+                     with_manager=manager, apk_path=apk, bundle_path=bundle,
+                     channel_url=channel_url)
+        return self.install_record()
+
+    def update(self, channel="canary", manager=False, apk=None, bundle=None,
+               workdir=None, restart=True, channel_url=None):
+        self.check(running=False)
+        arch, bits = get_arch()
+        self._mutate("Update failed", update,
+                     arch, bits, channel, restart_after=restart, workdir=workdir,
+                     with_manager=manager, apk_path=apk, bundle_path=bundle,
+                     channel_url=channel_url)
+        return self.install_record()
+
+    def remove(self, restart=True):
+        self.check(running=False)
+        self._mutate("Removal failed", uninstall, restart_after=restart)
+
+    def setup(self, restart=True):
+        self.check()
+        self._mutate("Setup failed", setup, restart_after=restart)
+
+    def rollback(self, generation=None, restart=True):
+        self.check(running=False, installed=False)
+        self._mutate("Rollback failed", rollback, generation, restart_after=restart)
+
+    def check_modules(self, modpaths):
+        with self._using():
+            return preflight_modules(modpaths)
+
+    def install_modules(self, modpaths, restart=True):
+        # A module is a zip path or the id of a module in the store.
+        self.check(setup=True)
+        resolved = []
+        for modpath in modpaths:
+            path = resolve_module(modpath)
+            if not path:
+                raise MagiskError("%s does not exist and is not in the module store" % modpath)
+            resolved.append(path)
+        results, errors = self.check_modules(resolved)
+        if errors:
+            raise MagiskError("Not installing any module:\n  %s" % "\n  ".join(errors))
+        try:
+            with self._using(), InstanceLock(exclusive=True), \
+                    WaydroidFreezeUnfreeze():
+                for modpath, result in zip(resolved, results):
+                    if not install_module(modpath, restart_after=False):
+                        raise MagiskError("Failed to install %s" % modpath)
+                    store_module(modpath, result)
+                if restart:
+                    restart_session_if_needed()
+        finally:
+            self._changed()
+
+    def export_modules(self, modids=None):
+        self.check(setup=True)
+        return self._call("Export failed", export_modules, modids)
+
+    def stored_modules(self):
+        return sorted((dict(entry, sha256=digest) for digest, entry
+                       in read_module_store()["modules"].items()),
+                      key=lambda entry: (entry["id"], version_code(entry)))
+
+    def su_audit(self, follow=False, interval=SU_AUDIT_INTERVAL, from_start=False):
+        # Yields the events, with follow until the caller stops. The instance
+        # is only entered while polling, not while the caller holds an event.
+        import sqlite3
+        self.check(running=False, installed=False)
+        events = su_audit(follow, interval, from_start)
+        while True:
+            with self._using():
+                try:
+                    event = next(events)
+                except StopIteration:
+                    return
+                except KeyError:
+                    raise MagiskError("Waydroid session data not found")
+                except sqlite3.Error as exc:
+                    raise MagiskError("Failed to read the su databases: %s" % exc) from exc
+            yield event
+
+    def module_profile(self, last=5):
+        with self._using():
+            try:
+                return module_profile(last)
+            except KeyError:
+                raise MagiskError("Waydroid session data not found")
+
+    def remove_module(self, modid, restart=True):
+        self.check(setup=True)
+        with self._using(), InstanceLock(exclusive=True):
+            modpath = os.path.join(
+                xdg_data_home(), "waydroid", "data", "adb", "modules", modid)
+            if not os.path.isdir(modpath):
+                raise MagiskError("'%s' is not an installed Magisk module" % modid)
+            logging.info("Removing '%s' Magisk module" % modid)
+            remove_path(modpath)
+            logging.info("'%s' Magisk module has been removed" % modid)
+            if restart:
+                restart_session_if_needed()
+
+    def set_policy(self, package, allow):
+        self.check(setup=True)
+        with self._using():
+            _name, app_id = get_package(package)
+            if not app_id:
+                raise MagiskError("Invalid package name")
+            magisk_sqlite("REPLACE INTO policies VALUES(%s,%s,0,1,1)" %
+                          (app_id, 2 if allow else 1))
+
+    def set_zygisk(self, enabled, new_zygisk=False):
+        self.check(setup=True)
+        statements = []
+        if enabled:
+            statements.append("REPLACE INTO settings (key,value) VALUES('zygisk',1)")
+            if new_zygisk:
+                statements.append("REPLACE INTO settings (key,value) VALUES('new_zygisk',1)")
+        else:
+            if not new_zygisk:
+                statements.append("REPLACE INTO settings (key,value) VALUES('zygisk',0)")
+            statements.append("REPLACE INTO settings (key,value) VALUES('new_zygisk',0)")
+        with self._using():
+            magisk_sqlite("; ".join(statements))
+
+    def apply_hidelist(self, entries):
+        # (package, process) pairs or dicts as returned by hidelist()
+        self.check(setup=True)
+        entries = {(entry["package"], entry["process"]) if isinstance(entry, dict)
+                   else tuple(entry) for entry in entries}
+        self._mutate("Failed to apply the hidelist", apply_hidelist, entries)
+
+    def apply(self, state, dry_run=False):
+        # state as documented for the apply command, paths relative to the
+        # current directory.
+        self.check(running=False, installed=False)
+        state = self._call("Invalid state", normalize_state, state, os.getcwd())
+        self._mutate("Failed to apply the state", apply_state, state, dry_run=dry_run)
+
+
+def check_environment():
     if os.path.exists("/sys/fs/selinux") and len(os.listdir("/sys/fs/selinux")) > 0:
         logging.error("Kitsune Mask doesn't support SELinux in Waydroid")
-        return
+        return False
     if not is_waydroid_initialized():
         logging.error("Waydroid is not initialized.")
-        return
-    arch, bits = get_arch()
+        return False
+    return True
+
 
+def main(argv=None, forward=True, root=None):
     parser = argparse.ArgumentParser(
         description="Kitsune Mask installer and manager for Waydroid",
         prog="waydroid_magisk")
@@ -910,6 +4013,26 @@ def main():
     parser.add_argument(
         "-o", "--ota", action="store_true",
         help="Handles survival during Waydroid updates (overlay only)")
+    parser.add_argument(
+        "--metrics-file", nargs="?", type=str,
+        default=os.environ.get("WMAGISKD_METRICS_FILE"),
+        help="Write OTA metrics to a Prometheus textfile collector file")
+    parser.add_argument(
+        "-r", "--root", action="append", type=str, default=None,
+        help="Waydroid root to manage (default %s), can be repeated" % WAYDROID_DIR)
+    parser.add_argument(
+        "--instances", type=str, default=None,
+        help="File listing Waydroid roots to manage, one per line")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=FLEET_JOBS,
+        help="Instances to manage in parallel (default %s)" % FLEET_JOBS)
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument(
+        "--json", action="store_const", const="json", dest="output",
+        default="text", help="Print query results as a JSON document")
+    output.add_argument(
+        "--ndjson", action="store_const", const="ndjson", dest="output",
+        help="Print query results as newline delimited JSON, one line per item")
 
     subparsers = parser.add_subparsers(dest="command")
     subparsers.add_parser("status", help="Query Magisk status")
@@ -930,6 +4053,12 @@ def main():
     parser_install.add_argument(
         "--apk", nargs="?", type=str, default=None, 
         help="Custom Kitsune Mask apk to use for installation")
+    parser_install.add_argument(
+        "--from-bundle", nargs="?", type=str, default=None,
+        help="Install from a bundle saved by a previous installation")
+    parser_install.add_argument(
+        "--channel-url", type=str, default=None,
+        help="Directory or URL of the channel files, e.g. a mirror (default upstream)")
 
     parser_install = subparsers.add_parser(
         "update", help="Update Kitsune Mask in Waydroid")
@@ -948,11 +4077,90 @@ def main():
     parser_install.add_argument(
         "--apk", nargs="?", type=str, default=None, 
         help="Custom Kitsune Mask apk to use for installation")
+    parser_install.add_argument(
+        "--from-bundle", nargs="?", type=str, default=None,
+        help="Install from a bundle saved by a previous installation")
+    parser_install.add_argument(
+        "--channel-url", type=str, default=None,
+        help="Directory or URL of the channel files, e.g. a mirror (default upstream)")
     
+    parser_check_update = subparsers.add_parser(
+        "check-update",
+        help="Check the Kitsune Mask channels for a newer build (exit %s if there is one)" % UPDATE_AVAILABLE)
+    parser_check_update.add_argument(
+        "--refresh", action="store_true",
+        help="Ignore the cached channel metadata")
+    parser_check_update.add_argument(
+        "--channel-url", type=str, default=None,
+        help="Directory or URL of the channel files, e.g. a mirror (default upstream)")
+
+    parser_mirror = subparsers.add_parser(
+        "mirror", help="Keep a local copy of the Kitsune Mask channels")
+    parser_mirror_subparser = parser_mirror.add_subparsers(
+        dest="command_mirror")
+    parser_mirror_sync = parser_mirror_subparser.add_parser(
+        "sync", help="Copy the channel files and apks to a directory")
+    parser_mirror_sync.add_argument(
+        "DIR", type=str, help="Mirror directory")
+    parser_mirror_sync.add_argument(
+        "--channel-url", type=str, default=None,
+        help="Directory or URL to sync from (default upstream)")
+    parser_mirror_serve = parser_mirror_subparser.add_parser(
+        "serve", help="Serve a mirror directory over HTTP")
+    parser_mirror_serve.add_argument(
+        "DIR", type=str, help="Mirror directory")
+    parser_mirror_serve.add_argument(
+        "-b", "--bind", type=str, default="",
+        help="Address to listen on (default all)")
+    parser_mirror_serve.add_argument(
+        "-p", "--port", type=int, default=MIRROR_PORT,
+        help="Port to listen on (default %s)" % MIRROR_PORT)
+
     subparsers.add_parser("setup", help="Setup magisk env")
 
+    subparsers.add_parser(
+        "verify", help="Verify installed Kitsune Mask files against the install record")
+
     subparsers.add_parser("remove", help="Remove Kitsune Mask from Waydroid")
 
+    parser_rollback = subparsers.add_parser(
+        "rollback", help="Restore the Kitsune Mask files saved before the last install/update")
+    parser_rollback.add_argument(
+        "-l", "--list", action="store_true", help="List saved generations")
+    parser_rollback.add_argument(
+        "GENERATION", nargs="?", type=str, default=None,
+        help="Generation to restore (default latest)")
+
+    parser_apply = subparsers.add_parser(
+        "apply", help="Bring Kitsune Mask, modules, su, hidelist and zygisk to a described state")
+    parser_apply.add_argument(
+        "STATE", type=str, help="JSON file describing the desired state")
+    parser_apply.add_argument(
+        "-n", "--dry-run", action="store_true",
+        help="Only print the changes that would be made")
+
+    parser_boottime = subparsers.add_parser(
+        "boottime", help="Time the Magisk boot stages")
+    parser_boottime_subparser = parser_boottime.add_subparsers(
+        dest="command_boottime")
+    parser_boottime_show = parser_boottime_subparser.add_parser(
+        "show", help="Summarize the recorded boot stage timings")
+    parser_boottime_show.add_argument(
+        "-n", "--boots", type=int, default=5,
+        help="Number of recent boots to summarize (default 5)")
+    parser_boottime_subparser.add_parser(
+        "enable", help="Record boot stage timings on every boot")
+    parser_boottime_subparser.add_parser(
+        "disable", help="Stop recording boot stage timings")
+    parser_boottime_subparser.add_parser(
+        "clear", help="Remove the recorded boot stage timings")
+
+    parser_daemon = subparsers.add_parser(
+        "daemon", help="Serve commands from a resident process")
+    parser_daemon.add_argument(
+        "-o", "--ota", action="store_true", dest="daemon_ota",
+        help="Also handle survival during Waydroid updates (overlay only)")
+
     parser_log = subparsers.add_parser("log", help="Follow magisk log.")
     parser_log.add_argument(
         "-s", "--save", action="store_true", help="Save magisk log locally")
@@ -964,13 +4172,33 @@ def main():
     parser_modules_install = parser_modules_subparser.add_parser(
         "install", help="Install magisk module")
     parser_modules_install.add_argument(
-        "MODULE", type=str, help="Path to magisk module to install")
+        "MODULE", nargs="+", type=str,
+        help="Path or module store id (id[@versionCode]) of magisk module(s) to install")
     parser_modules_remove = parser_modules_subparser.add_parser(
         "remove", help="Remove magisk module")
     parser_modules_remove.add_argument(
         "MODULE", type=str, help="Module name to remove")
     parser_modules_list = parser_modules_subparser.add_parser(
         "list", help="List all installed magisk modules")
+    parser_modules_check = parser_modules_subparser.add_parser(
+        "check", help="Validate magisk module zip(s) without installing them")
+    parser_modules_check.add_argument(
+        "MODULE", nargs="+", type=str, help="Path to magisk module(s) to check")
+    parser_modules_export = parser_modules_subparser.add_parser(
+        "export", help="Save installed magisk module(s) to the module store",
+        epilog="Modules installed with this tool are already in the store as "
+        "their original zip. Others are packed from their installed files: "
+        "empty directories and the permissions or SELinux contexts set by "
+        "their customize.sh are not kept.")
+    parser_modules_export.add_argument(
+        "MODULE", nargs="*", type=str, help="Module name(s) to export (default all)")
+    parser_modules_subparser.add_parser(
+        "store", help="List the magisk modules in the module store")
+    parser_modules_profile = parser_modules_subparser.add_parser(
+        "profile", help="Rank modules by the boot time of their scripts (needs boottime enable)")
+    parser_modules_profile.add_argument(
+        "-n", "--boots", type=int, default=5,
+        help="Number of recent boots to rank (default 5)")
 
     parser_su = subparsers.add_parser("su", help="Manage su in Kitsune Mask")
     parser_su_subparser = parser_su.add_subparsers(dest="command_su")
@@ -983,6 +4211,16 @@ def main():
     parser_su_deny = parser_su_subparser.add_parser(
         "deny", help="Deny su access to app")
     parser_su_deny.add_argument("PKG", type=str, help="PKG")
+    parser_su_audit = parser_su_subparser.add_parser(
+        "audit", help="Print su requests and policy changes since the last audit as NDJSON")
+    parser_su_audit.add_argument(
+        "-f", "--follow", action="store_true", help="Keep printing new events")
+    parser_su_audit.add_argument(
+        "-i", "--interval", type=float, default=SU_AUDIT_INTERVAL,
+        help="Seconds between polls with --follow (default %s)" % SU_AUDIT_INTERVAL)
+    parser_su_audit.add_argument(
+        "--from-start", action="store_true",
+        help="Print the whole su log instead of starting after the last audit")
 
     parser_hide = subparsers.add_parser(
         "magiskhide", help="Execute magisk hide commands")
@@ -1002,6 +4240,10 @@ def main():
         "PKG", nargs="+", type=str, help="PKG [PROC]")
     parser_hide_ls = parser_hide_subparser.add_parser(
         "ls", help="Print the current hidelist (sulist)")
+    parser_hide_apply = parser_hide_subparser.add_parser(
+        "apply", help="Make the hidelist (sulist) match a list of targets")
+    parser_hide_apply.add_argument(
+        "FILE", type=str, help="File with one PKG [PROC] per line, - for stdin")
 
     parser_zygisk = subparsers.add_parser(
         "zygisk", help="Execute zygisk commands")
@@ -1021,131 +4263,256 @@ def main():
     parser_zygisk_disable.add_argument("-n", "--new-zygisk", action="store_true", help="Disable new way to load Zygisk. "
                                       "this feature is experimental and it can break some hooking module")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    parser_help = {
+        "boottime": parser_boottime.print_help,
+        "module": parser_modules.print_help,
+        "su": parser_su.print_help,
+        "magiskhide": parser_hide.print_help,
+        "zygisk": parser_zygisk.print_help,
+        "mirror": parser_mirror.print_help,
+    }
+
+    if not args.command and not args.ota:
+        if args.version:
+            print(VERSION)
+        else:
+            parser.print_help()
+        return
+    if argv is None:
+        argv = sys.argv[1:]
+    if forward and is_daemon_command(args):
+        status = call_daemon(argv)
+        if status is not None:
+            return status
+
+    roots = [root] if root else list(args.root or [])
+    if not root and args.instances:
+        roots.extend(read_instances(args.instances))
+    if len(roots) > 1:
+        if args.command not in FLEET_COMMANDS or (
+                args.command == "module" and args.command_module != "install"):
+            logging.error("Only %s and module install can manage several instances" %
+                          ", ".join(FLEET_COMMANDS[:-1]))
+            return 1
+        return run_fleet(argv, roots, max(1, args.jobs), output=args.output)
+    set_instance(roots[0] if roots else WAYDROID_DIR)
+
+    # A mirror is plain files, it needs neither root nor Waydroid.
+    if args.command != "mirror" and not check_environment():
+        return 1
+
+    manager = Manager(instance().waydroid_dir, persistent_shell=False)
+    try:
+        return run_command(args, manager, parser_help)
+    except MagiskError as exc:
+        logging.error(exc)
+        if args.output != "text":
+            emit(args.output, {"error": str(exc), "type": type(exc).__name__})
+        return 1
+
+
+def emit(output, document):
+    if output == "ndjson":
+        for item in document if isinstance(document, list) else [document]:
+            print(json.dumps(item, sort_keys=True))
+    else:
+        print(json.dumps(document, sort_keys=True, indent=2))
+
 
+def run_command(args, manager, parser_help):
+    structured = args.output != "text"
     if args.command == "status":
-        magisk_status()
+        if structured:
+            emit(args.output, manager.report())
+            return
+        status = manager.status()
+        logging.info("Daemon: %s" % ("Running" if status["daemon"] else "Stopped"))
+        if status["error"]:
+            logging.error(status["error"])
+        logging.info("Magisk Version: %s" % status["version"])
     elif args.command == "install" or args.command == "update":
         # stable is disabled for now
         magisk_channel = "canary" if args.canary else "debug" if args.debug else "canary"
-        install_fnc = update if args.command == "update" else install
-        if args.tmpdir == "tmpdir":
-            install_fnc(arch, bits, magisk_channel, restart_after=True,
-                        with_manager=args.manager, apk_path=args.apk)
-        else:
-            install_fnc(
-                arch, bits, magisk_channel, workdir=args.tmpdir,
-                restart_after=True, with_manager=args.manager, apk_path=args.apk)
+        install_fnc = manager.update if args.command == "update" else manager.install
+        install_fnc(magisk_channel, manager=args.manager, apk=args.apk,
+                    bundle=args.from_bundle,
+                    workdir=None if args.tmpdir == "tmpdir" else args.tmpdir,
+                    channel_url=args.channel_url)
+    elif args.command == "check-update":
+        if structured:
+            status = manager.update_status(
+                refresh=args.refresh, channel_url=args.channel_url)
+            emit(args.output, status)
+            return UPDATE_AVAILABLE if status["update_available"] else 0
+        return check_update(refresh=args.refresh, channel_url=args.channel_url)
     elif args.command == "setup":
-        setup()
+        manager.setup()
+    elif args.command == "verify":
+        verified = manager.verify()
+        if structured:
+            emit(args.output, {"verified": verified, "install": manager.install_record()})
+        return 0 if verified else 1
+    elif args.command == "rollback":
+        if args.list and structured:
+            emit(args.output, manager.generations())
+        elif args.list:
+            for generation in manager.generations():
+                print("- %s | %s | %s" % (
+                    generation["name"], generation["reason"],
+                    generation.get("version") or "not installed"))
+        else:
+            manager.rollback(args.GENERATION)
     elif args.command == "remove":
-        uninstall(restart_after=True)
+        manager.remove()
+    elif args.command == "apply":
+        state = read_state(args.STATE)
+        if state is None:
+            return 1
+        manager.apply(state, dry_run=args.dry_run)
+    elif args.command == "mirror":
+        if args.command_mirror == "sync":
+            try:
+                index = mirror_sync(args.DIR, channel_url=args.channel_url)
+            except (OSError, ValueError) as exc:
+                logging.error("Mirror sync failed: %s" % exc)
+                return 1
+            if structured:
+                emit(args.output, index)
+        elif args.command_mirror == "serve":
+            return 0 if mirror_serve(args.DIR, args.bind, args.port) else 1
+        else:
+            parser_help["mirror"]()
+    elif args.command == "boottime":
+        if args.command_boottime == "show":
+            return 0 if boottime(max(1, args.boots)) else 1
+        elif args.command_boottime in ["enable", "disable"]:
+            set_boottime(args.command_boottime == "enable")
+        elif args.command_boottime == "clear":
+            clear_boottime()
+        else:
+            parser_help["boottime"]()
     elif args.command == "log":
         magisk_log(save=args.save)
     elif args.command == "module":
-        if is_running() and not is_set_up():
-            logging.error("Incomplete magisk setup")
-            return
         if args.command_module == "install":
-            install_module(args.MODULE)
+            manager.install_modules(args.MODULE)
         elif args.command_module == "remove":
-            remove_module(args.MODULE)
+            manager.remove_module(args.MODULE)
+        elif args.command_module == "export":
+            exported = manager.export_modules(args.MODULE)
+            if structured:
+                emit(args.output, exported)
+        elif args.command_module == "store":
+            stored = manager.stored_modules()
+            if structured:
+                emit(args.output, stored)
+            else:
+                for entry in stored:
+                    print("- %s %s (%s) %s" % (entry["id"], entry["version"],
+                                               entry["versionCode"], entry["sha256"][:12]))
+        elif args.command_module == "profile":
+            count, profile = manager.module_profile(max(1, args.boots))
+            if structured:
+                emit(args.output, profile)
+                return
+            return 0 if show_module_profile(count, profile) else 1
+        elif args.command_module == "check":
+            results, errors = manager.check_modules(args.MODULE)
+            if structured:
+                emit(args.output, {"modules": results, "errors": errors})
+            else:
+                for result in results:
+                    if not result["errors"]:
+                        print("%s: %s %s (%s)" % (result["path"], result["id"],
+                                                  result["version"], result["versionCode"]))
+                for error in errors:
+                    logging.error(error)
+            return 1 if errors else 0
         elif args.command_module == "list":
-            list_modules()
+            modules = manager.modules()
+            if structured:
+                emit(args.output, modules)
+                return
+            if not modules:
+                logging.error("No Magisk modules are currently installed")
+                return
+            print("\n".join("- %s" % module["id"] for module in modules))
         else:
-            parser_modules.print_help()
+            parser_help["module"]()
     elif args.command == "su":
-        if is_running() and not is_set_up():
-            logging.error("Incomplete magisk setup")
-            return
         if args.command_su == "shell":
+            manager.check(setup=True)
             su()
+        elif args.command_su == "list" and structured:
+            emit(args.output, manager.policies())
         elif args.command_su == "list":
-            result = magisk_sqlite("SELECT * FROM policies")
-            for line in result.splitlines():
-                _logging, notification, policy, uid, until = line.split("|")
-                pkg, uid = get_package(int(uid.split("=")[-1]))
-                if pkg:
-                    print(
-                        "- %s | %s" %
-                        (pkg, "allowed"
-                         if int(policy.split("=")[-1]) == 2 else "denied"))
+            for policy in manager.policies():
+                if policy["package"]:
+                    print("- %s | %s" % (
+                        policy["package"],
+                        "allowed" if policy["policy"] == "allow" else "denied"))
         elif args.command_su in ["allow", "deny"]:
-            policy = "2" if args.command_su == "allow" else "1"
-            pkg, app_id = get_package(args.PKG)
-            if not app_id:
-                logging.error("Invalid package name")
+            manager.set_policy(args.PKG, args.command_su == "allow")
+        elif args.command_su == "audit":
+            events = manager.su_audit(args.follow, max(0.1, args.interval), args.from_start)
+            if args.output == "json":
+                if args.follow:
+                    raise MagiskError("--follow prints NDJSON, not a JSON document")
+                emit(args.output, list(events))
                 return
-            magisk_sqlite("REPLACE INTO policies VALUES(%s,%s,0,1,1)" %
-                          (app_id, policy))
+            try:
+                for event in events:
+                    print(json.dumps(event, sort_keys=True), flush=True)
+            except KeyboardInterrupt:
+                pass
         else:
-            parser_su.print_help()
+            parser_help["su"]()
     elif args.command == "magiskhide":
-        if is_running() and not is_set_up():
-            logging.error("Incomplete magisk setup")
-            return
-        cmd = ["magiskhide"]
-        if args.command_magiskhide == "status":
-            cmd.append("status")
-        elif args.command_magiskhide == "sulist":
-            cmd.append("sulist")
-        elif args.command_magiskhide == "enable":
-            cmd.append("enable")
-        elif args.command_magiskhide == "disable":
-            cmd.append("disable")
+        if args.command_magiskhide == "apply":
+            if args.FILE == "-":
+                desired = read_hidelist(sys.stdin)
+            else:
+                try:
+                    with open(args.FILE, "r") as handle:
+                        desired = read_hidelist(handle)
+                except OSError as exc:
+                    logging.error("Failed to read %s: %s" % (args.FILE, exc))
+                    return 1
+            if desired is None:
+                return 1
+            manager.apply_hidelist(desired)
+        elif args.command_magiskhide == "ls" and structured:
+            emit(args.output, manager.hidelist())
+        elif args.command_magiskhide in ["status", "sulist"] and structured:
+            emit(args.output, {"command": args.command_magiskhide,
+                               "message": manager.magiskhide(args.command_magiskhide).strip()})
+        elif args.command_magiskhide in ["status", "sulist", "enable", "disable", "ls"]:
+            sys.stdout.write(manager.magiskhide(args.command_magiskhide))
         elif args.command_magiskhide == "add":
-            cmd.extend(["add", args.PKG])
+            sys.stdout.write(manager.magiskhide("add", args.PKG))
         elif args.command_magiskhide == "rm":
-            cmd.append("rm")
-            cmd.extend(args.PKG)
-        elif args.command_magiskhide == "ls":
-            cmd.append("ls")
+            sys.stdout.write(manager.magiskhide("rm", *args.PKG))
         else:
-            parser_hide.print_help()
-        if len(cmd) > 1:
-            status, message = magisk_cmd(cmd)
-            if status == 1:
-                logging.error(message)
+            parser_help["magiskhide"]()
     elif args.command == "zygisk":
-        if is_running() and not is_set_up():
-            logging.error("Incomplete magisk setup")
-            return
-        if args.command_zygisk == "status":
-            result = magisk_sqlite(
-                "SELECT value FROM settings WHERE key == 'zygisk'")
-            result_new = magisk_sqlite(
-                "SELECT value FROM settings WHERE key == 'new_zygisk'")
-            state = result and int(result.split("=")[-1]) == 1
-            state_new = result_new and int(result_new.split("=")[-1]) == 1
-            if not state_new:
-                logging.info("Zygisk is %s" %
-                            ("enabled" if state else "disabled"))
-            else:
-                logging.info("Zygisk is %s (Experimental)" %
-                            ("enabled" if state else "disabled"))
-        elif args.command_zygisk == "enable":
-            magisk_sqlite(
-                "REPLACE INTO settings (key,value) VALUES('zygisk',1)")
-            if args.new_zygisk:
-                magisk_sqlite(
-                "REPLACE INTO settings (key,value) VALUES('new_zygisk', 1)"
-                        )
-        elif args.command_zygisk == "disable":
-            if not args.new_zygisk:
-                magisk_sqlite(
-                    "REPLACE INTO settings (key,value) VALUES('zygisk',0)")
-            magisk_sqlite(
-                "REPLACE INTO settings (key,value) VALUES('new_zygisk', 0)"
-                    )
+        if args.command_zygisk == "status" and structured:
+            emit(args.output, manager.zygisk())
+        elif args.command_zygisk == "status":
+            zygisk = manager.zygisk()
+            logging.info("Zygisk is %s%s" % (
+                "enabled" if zygisk["enabled"] else "disabled",
+                " (Experimental)" if zygisk["new_zygisk"] else ""))
+        elif args.command_zygisk in ["enable", "disable"]:
+            manager.set_zygisk(args.command_zygisk == "enable",
+                               new_zygisk=args.new_zygisk)
         else:
-            parser_zygisk.print_help()
+            parser_help["zygisk"]()
+    elif args.command == "daemon":
+        daemon(with_ota=args.daemon_ota, metrics_file=args.metrics_file)
     elif args.ota:
-        ota()
-    elif args.version:
-        print(VERSION)
-    else:
-        parser.print_help()
+        ota(metrics_file=args.metrics_file)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())